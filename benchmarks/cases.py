@@ -0,0 +1,52 @@
+"""
+Benchmark cases. Each is a module level function, so that it can be run
+in the harness worker processes, which exercises one parser or
+generator on one file.
+"""
+
+import os
+import tempfile
+
+from tendril.config import MEDIA_VIDEO_EXTENSIONS
+from tendril.config import MEDIA_IMAGE_EXTENSIONS
+
+from tendril.utils.parsers.media.info import get_media_info
+from tendril.utils.parsers.media.thumbnails import generate_thumbnail
+from tendril.utils.parsers.media.thumbnails import generate_thumbnails
+
+
+def info(path, **kwargs):
+    get_media_info(path, original_filename=os.path.split(path)[1], **kwargs)
+
+
+def thumbnail(path, size=256):
+    generate_thumbnail(path, size=size)
+
+
+def thumbnails(path):
+    generate_thumbnails(path)
+
+
+def thumbnail_to_disk(path, size=256):
+    with tempfile.TemporaryDirectory() as output_dir:
+        generate_thumbnail(path, output_dir, size=size)
+
+
+def build_cases(corpus):
+    """
+    Returns a dict of case name to (func, args, kwargs) for the given
+    corpus of extension to path.
+    """
+    rv = {}
+    for ext, path in sorted(corpus.items()):
+        name = ext.lstrip('.')
+        rv[f'info.{name}'] = (info, (path,), {})
+        if ext in MEDIA_IMAGE_EXTENSIONS:
+            rv[f'info.{name}.pil'] = (info, (path,), {'engine': 'pil'})
+        elif ext in MEDIA_VIDEO_EXTENSIONS:
+            rv[f'info.{name}.pyav'] = (info, (path,), {'engine': 'pyav'})
+            rv[f'info.{name}.fast'] = (info, (path,), {'fast': True})
+        rv[f'thumbnail.{name}'] = (thumbnail, (path,), {})
+        rv[f'thumbnail.{name}.disk'] = (thumbnail_to_disk, (path,), {})
+        rv[f'thumbnails.{name}'] = (thumbnails, (path,), {})
+    return rv
@@ -0,0 +1,137 @@
+"""
+Synthetic media corpora for the benchmarks, generated locally so that
+the benchmarks can be run at scales the test media don't cover.
+"""
+
+import os
+from fractions import Fraction
+
+
+# Parameters of the corpus at scale 1. Scales multiply the number of
+# pixels for images, the duration for videos and the page count for
+# documents.
+IMAGE_SIZE = (6000, 4000)
+VIDEO_SIZE = (1280, 720)
+VIDEO_DURATION = 60
+VIDEO_FPS = 25
+VIDEO_GOP = 250
+DOCUMENT_PAGES = 200
+
+_image_formats = {
+    '.jpg': ('JPEG', {'quality': 90}),
+    '.png': ('PNG', {}),
+    '.webp': ('WEBP', {'quality': 90}),
+    '.tiff': ('TIFF', {}),
+}
+
+# Codecs to try for each container, in order of preference
+_video_codecs = {
+    '.mp4': ['h264', 'mpeg4'],
+    '.mov': ['h264', 'mpeg4'],
+    '.avi': ['mpeg4'],
+    '.webm': ['libvpx-vp9', 'libvpx'],
+    '.mkv': ['h264', 'mpeg4'],
+}
+
+
+def _image(size, seed=0):
+    from PIL import Image
+    from PIL import ImageDraw
+    # A gradient with noise and some shapes, to give the encoders and
+    # decoders something closer to a photograph than a flat image.
+    image = Image.linear_gradient('L').resize(size).convert('RGB')
+    noise = Image.effect_noise(size, 48).convert('RGB')
+    image = Image.blend(image, noise, 0.35)
+    draw = ImageDraw.Draw(image)
+    step = max(1, size[0] // 12)
+    for idx, x in enumerate(range(0, size[0], step)):
+        color = ((seed * 37 + idx * 53) % 256, (idx * 97) % 256, (seed * 11 + idx * 29) % 256)
+        draw.ellipse((x, size[1] // 4, x + step, size[1] // 4 + step), fill=color)
+    return image
+
+
+def generate_image(path, scale=1):
+    from math import sqrt
+    factor = sqrt(scale)
+    size = (int(IMAGE_SIZE[0] * factor), int(IMAGE_SIZE[1] * factor))
+    pil_format, options = _image_formats[os.path.splitext(path)[1]]
+    _image(size).save(path, format=pil_format, **options)
+    return path
+
+
+def generate_video(path, scale=1):
+    import av
+    ext = os.path.splitext(path)[1]
+    duration = VIDEO_DURATION * scale
+    base = _image(VIDEO_SIZE)
+    with av.open(path, 'w') as container:
+        stream = None
+        for codec in _video_codecs[ext]:
+            try:
+                stream = container.add_stream(codec, rate=Fraction(VIDEO_FPS))
+                break
+            except (ValueError, av.error.FFmpegError):
+                continue
+        if stream is None:
+            raise ValueError(f"No usable codec available for {ext}")
+        stream.width, stream.height = VIDEO_SIZE
+        stream.pix_fmt = 'yuv420p'
+        stream.codec_context.gop_size = VIDEO_GOP
+        for idx in range(int(duration * VIDEO_FPS)):
+            # Scroll the base image so consecutive frames differ
+            shift = (idx * 8) % VIDEO_SIZE[0]
+            frame_image = base.transform(VIDEO_SIZE, 0, (1, 0, shift, 0, 1, 0), fillcolor=(0, 0, 0)) \
+                if shift else base
+            frame = av.VideoFrame.from_image(frame_image)
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return path
+
+
+def generate_document(path, scale=1):
+    from PIL import ImageDraw
+    pages = int(DOCUMENT_PAGES * scale)
+    size = (1240, 1754)     # A4 at 150 DPI
+    images = []
+    for idx in range(pages):
+        image = _image((size[0] // 4, size[1] // 4), seed=idx).resize(size)
+        ImageDraw.Draw(image).text((100, 100), f"Page {idx + 1}", fill=(0, 0, 0))
+        images.append(image)
+    images[0].save(path, format='PDF', save_all=True, append_images=images[1:],
+                   resolution=150)
+    return path
+
+
+_generators = {
+    'image': (generate_image, list(_image_formats.keys())),
+    'video': (generate_video, list(_video_codecs.keys())),
+    'document': (generate_document, ['.pdf']),
+}
+
+
+def build_corpus(corpus_dir, exts, scale=1):
+    """
+    Generate a corpus file for each of the given extensions we know how
+    to synthesize, reusing any already present in corpus_dir. Returns a
+    dict of extension to path.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    rv = {}
+    for generator, supported in _generators.values():
+        for ext in supported:
+            if ext not in exts:
+                continue
+            path = os.path.join(corpus_dir, f'corpus_s{scale}{ext}')
+            if not os.path.exists(path):
+                print(f"Generating {path}")
+                try:
+                    generator(path, scale=scale)
+                except Exception as e:
+                    print(f"Could not generate {path} : {e!r}")
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+            rv[ext] = path
+    return rv
@@ -0,0 +1,78 @@
+"""
+Runs benchmark cases in fresh worker processes and collects latency,
+throughput and peak RSS figures for each.
+"""
+
+import os
+import time
+import resource
+import multiprocessing
+from statistics import median
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[idx]
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rv = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname().sysname == 'Darwin':
+        rv = rv / 1024
+    return rv / 1024
+
+
+def _run_case(func, args, kwargs, repeats, warmup):
+    for _ in range(warmup):
+        func(*args, **kwargs)
+    baseline_rss = _peak_rss()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        t = time.perf_counter()
+        func(*args, **kwargs)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    return {
+        'repeats': repeats,
+        'throughput': repeats / elapsed,
+        'mean_ms': 1000 * elapsed / repeats,
+        'p50_ms': 1000 * median(latencies),
+        'p99_ms': 1000 * _percentile(latencies, 99),
+        'peak_rss_mb': _peak_rss(),
+        'baseline_rss_mb': baseline_rss,
+    }
+
+
+def run_case(func, *args, repeats=10, warmup=1, **kwargs):
+    """
+    Run func(*args, **kwargs) repeats times in a freshly spawned process,
+    so that the peak RSS reported is that of this case alone. func needs
+    to be importable by the child process.
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_run_case, func, args, kwargs, repeats, warmup).result()
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Compare results against a baseline, both dicts of case name to
+    figures. Returns a list of (case, metric, baseline, current) for
+    each metric which regressed by more than threshold.
+    """
+    rv = []
+    for name, figures in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('p50_ms', 'p99_ms', 'peak_rss_mb'):
+            reference = baseline[name].get(metric)
+            if reference and figures[metric] > reference * (1 + threshold):
+                rv.append((name, metric, reference, figures[metric]))
+        reference = baseline[name].get('throughput')
+        if reference and figures['throughput'] < reference * (1 - threshold):
+            rv.append((name, 'throughput', reference, figures['throughput']))
+    return rv
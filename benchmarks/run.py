@@ -0,0 +1,105 @@
+"""
+Benchmark suite for the media info parsers and thumbnail generators.
+
+Run from the root of the repository with, for instance :
+
+    python -m benchmarks.run --scale 1 --save-baseline 1.2.0
+
+Results are written as JSON, and can be compared against a stored
+baseline to catch regressions between releases. The exit status is
+non-zero if any case regressed by more than the threshold.
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from tendril.config import MEDIA_VIDEO_EXTENSIONS
+from tendril.config import MEDIA_IMAGE_EXTENSIONS
+from tendril.config import MEDIA_DOCUMENT_EXTENSIONS
+
+from .corpus import build_corpus
+from .cases import build_cases
+from .harness import run_case
+from .harness import compare
+
+
+BASELINES_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+
+def _print_results(results):
+    print(f"{'case':<28}{'files/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'RSS MB':>10}")
+    for name, figures in results.items():
+        print(f"{name:<28}{figures['throughput']:>10.2f}{figures['p50_ms']:>10.2f}"
+              f"{figures['p99_ms']:>10.2f}{figures['peak_rss_mb']:>10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--corpus-dir', default=os.path.join('benchmarks', '.corpus'))
+    parser.add_argument('--scale', type=float, default=1)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--filter', default=None,
+                        help="Regular expression selecting the cases to run")
+    parser.add_argument('--output', default=None,
+                        help="Path to write the results to as JSON")
+    parser.add_argument('--save-baseline', default=None, metavar='NAME',
+                        help="Also save the results as the named baseline")
+    parser.add_argument('--baseline', default=None, metavar='NAME',
+                        help="Compare the results against the named baseline")
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    exts = MEDIA_VIDEO_EXTENSIONS + MEDIA_IMAGE_EXTENSIONS + MEDIA_DOCUMENT_EXTENSIONS
+    # The corpus is built in a worker process. On Linux, the peak RSS
+    # of a process carries over into the processes it spawns, so the
+    # cases would otherwise all report the peak of building the corpus.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        corpus = executor.submit(build_corpus, args.corpus_dir, exts,
+                                 scale=args.scale).result()
+    cases = build_cases(corpus)
+    if args.filter:
+        cases = {k: v for k, v in cases.items() if re.search(args.filter, k)}
+
+    results = {}
+    for name, (func, case_args, case_kwargs) in cases.items():
+        try:
+            results[name] = run_case(func, *case_args, repeats=args.repeats, **case_kwargs)
+        except Exception as e:
+            print(f"Case {name} failed : {e!r}")
+    _print_results(results)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'scale': args.scale,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(os.path.join(BASELINES_DIR, f'{args.save_baseline}.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(os.path.join(BASELINES_DIR, f'{args.baseline}.json')) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != args.scale:
+            print(f"Warning : Baseline was recorded at scale {baseline.get('scale')}")
+        regressions = compare(results, baseline['results'], threshold=args.threshold)
+        for name, metric, reference, current in regressions:
+            print(f"REGRESSION {name} {metric} : {reference:.2f} -> {current:.2f}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
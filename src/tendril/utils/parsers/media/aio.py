@@ -0,0 +1,121 @@
+
+
+import asyncio
+import inspect
+import tempfile
+import weakref
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from tendril.config import MEDIA_VIDEO_EXTENSIONS
+from tendril.config import MEDIA_IMAGE_EXTENSIONS
+from tendril.config import MEDIA_DOCUMENT_EXTENSIONS
+
+
+# Async file-like objects are read into memory up to this size before
+# being spilled over to a temporary file on disk.
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+_executor = None
+
+# Maximum number of concurrent jobs per media type, per event loop. The
+# None entry applies to anything not covered by the other types.
+_concurrency_limits = {
+    'video': 2,
+    'image': 8,
+    'document': 2,
+    None: 4,
+}
+
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _build_media_types():
+    rv = {}
+    for media_type, exts in [
+        ('video', MEDIA_VIDEO_EXTENSIONS),
+        ('image', MEDIA_IMAGE_EXTENSIONS),
+        ('document', MEDIA_DOCUMENT_EXTENSIONS),
+    ]:
+        for ext in exts:
+            rv[ext] = media_type
+    return rv
+
+
+_media_types = _build_media_types()
+
+
+def get_media_type(ext):
+    return _media_types.get(ext, None)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(thread_name_prefix='tendril-media')
+    return _executor
+
+
+def set_executor(executor):
+    """
+    Set the executor on which the blocking work of the async parsers and
+    generators is run. By default, a shared ThreadPoolExecutor is used.
+    """
+    global _executor
+    _executor = executor
+
+
+def set_concurrency_limit(media_type, limit):
+    """
+    Set the maximum number of concurrent async jobs for the media type
+    ('video', 'image', 'document' or None for everything else). Applies
+    to event loops which have not yet run a job of that type.
+    """
+    _concurrency_limits[media_type] = limit
+
+
+def _get_semaphore(media_type):
+    loop = asyncio.get_running_loop()
+    semaphores = _semaphores.setdefault(loop, {})
+    if media_type not in semaphores:
+        limit = _concurrency_limits.get(media_type, _concurrency_limits[None])
+        semaphores[media_type] = asyncio.Semaphore(limit)
+    return semaphores[media_type]
+
+
+async def run_limited(media_type, func, *args, **kwargs):
+    """
+    Run func on the shared executor, waiting for a slot within the
+    concurrency limit of the media type first.
+    """
+    async with _get_semaphore(media_type):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(),
+                                          partial(func, *args, **kwargs))
+
+
+def is_async_file(file):
+    return inspect.iscoroutinefunction(getattr(file, 'read', None))
+
+
+def get_filename(file):
+    if isinstance(file, str):
+        return file
+    elif hasattr(file, 'filename'):
+        return file.filename
+    return getattr(file, 'name', None)
+
+
+async def spool(file, chunk_size=1024 * 1024):
+    """
+    Read an async file-like object into a seekable SpooledTemporaryFile
+    which the blocking parsers and generators can work with.
+    """
+    rv = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        rv.write(chunk)
+    rv.seek(0)
+    return rv
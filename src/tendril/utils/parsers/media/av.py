@@ -3,6 +3,8 @@
 from decimal import Decimal
 from typing import Optional
 from pydantic.dataclasses import dataclass
+from .base import construct
+from .base import compact_class
 from .base import MediaFileGeneralInfo
 
 
@@ -17,6 +19,17 @@ class MediaTrackInfo(object):
     format: str
     stream_size: Optional[int]          # Missing in GIF
 
+    _compact = True
+
+    @classmethod
+    def from_dict(cls, data, compact=False):
+        return construct(cls, data, compact=compact)
+
+    def compact(self):
+        # Slotted copy of the track info. See base.compact_class
+        klass = compact_class(type(self))
+        return klass(*(getattr(self, f) for f in klass.__slots__))
+
 
 @dataclass
 class AVTrackInfo(MediaTrackInfo):
@@ -73,3 +86,10 @@ class ImageTrackInfo(MediaTrackInfo):
     bit_depth: Optional[int]
     color_space: Optional[str]
     chroma_subsampling: Optional[str]
+
+
+# Slotted twins of the track info classes, bound here so that compact
+# records can be pickled, such as when returned from process pool workers.
+CompactVideoTrackInfo = compact_class(VideoTrackInfo)
+CompactAudioTrackInfo = compact_class(AudioTrackInfo)
+CompactImageTrackInfo = compact_class(ImageTrackInfo)
@@ -1,19 +1,431 @@
 
 
+import io
 import os
 import json
+import mmap
+import typing
+import tempfile
+import importlib
+from decimal import Decimal
+from typing import List
+from typing import Union
 from typing import Optional
 from pydantic.dataclasses import dataclass
 from dataclasses import asdict
+from dataclasses import fields
+from dataclasses import is_dataclass
+from dataclasses import dataclass as plain_dataclass
 from pydantic.json import pydantic_encoder
+from tendril import config
 
-from PIL import Image
+from . import instrumentation
+from .encoders import get_encoder
+from .encoders import get_encoder_for_path
+
+
+# Non-seekable streams are held in memory up to this size as they are
+# read, before being spilled over to a temporary file on disk.
+MEDIA_STREAM_SPOOL_MAX_SIZE = getattr(config, 'MEDIA_STREAM_SPOOL_MAX_SIZE', 16 * 1024 * 1024)
+
+
+class LazyDispatch(object):
+    """
+    Mapping of file extensions to parser or generator instances, built
+    from (spec, extensions) entries with later entries taking precedence.
+    A spec is either an instance, or a 'module:ClassName' string with the
+    module relative to package. The module is only imported, and the
+    class instantiated, when an extension which needs it is first looked
+    up. Each class is instantiated once and shared by its extensions.
+    """
+    def __init__(self, package, entries):
+        self._package = package
+        self._specs = {}
+        self._instances = {}
+        self._resolved = {}
+        for spec, exts in entries:
+            for ext in exts:
+                self._specs[ext] = spec
+
+    def _resolve(self, spec):
+        if not isinstance(spec, str):
+            return spec
+        try:
+            return self._instances[spec]
+        except KeyError:
+            module_name, class_name = spec.split(':')
+            module = importlib.import_module(module_name, self._package)
+            rv = self._instances[spec] = getattr(module, class_name)()
+            return rv
+
+    def __getitem__(self, ext):
+        try:
+            return self._resolved[ext]
+        except KeyError:
+            rv = self._resolved[ext] = self._resolve(self._specs[ext])
+            return rv
+
+    def __contains__(self, ext):
+        return ext in self._specs
+
+    def get(self, ext, default=None):
+        try:
+            return self[ext]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._specs.keys()
+
+
+class MediaFileView(io.RawIOBase):
+    """
+    Seekable, read-only file-like view over a buffer, such as a memory
+    mapped file, with its own independent position. Reads copy only the
+    requested bytes out of the buffer, and getbuffer provides zero-copy
+    access to the whole of it.
+    """
+    def __init__(self, buffer, name=None, path=None, owner=None):
+        super(MediaFileView, self).__init__()
+        self._buffer = memoryview(buffer)
+        self._position = 0
+        self._owner = owner
+        self.name = name
+        self.path = path
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def getbuffer(self):
+        return self._buffer
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._buffer)
+        else:
+            end = min(self._position + size, len(self._buffer))
+        rv = bytes(self._buffer[self._position:end])
+        self._position = max(self._position, end)
+        return rv
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._buffer) - self._position))
+        b[:n] = self._buffer[self._position:self._position + n]
+        self._position += n
+        return n
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = len(self._buffer) + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if self.closed:
+            return
+        self._buffer.release()
+        super(MediaFileView, self).close()
+        if self._owner:
+            self._owner.close()
+
+
+class MediaInput(object):
+    """
+    Read-only, memory mapped access to a media file on disk. Hands out
+    any number of independent MediaFileViews over the mapping, so that
+    the parsers and generators can share the file without each reading
+    their own copy of it into memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self._mmap = None
+
+    def view(self, owned=False):
+        # If owned, closing the view also closes the MediaInput.
+        buffer = self._mmap if self._mmap is not None else b''
+        return MediaFileView(buffer, name=self.path, path=self.path,
+                             owner=self if owned else None)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Views are still being held on to somewhere. The mapping
+                # is closed when they are garbage collected.
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_media(path):
+    """
+    Drop-in replacement for open(path, 'rb') for media files, returning a
+    view over a memory mapping of the file. See MediaInput.
+    """
+    return MediaInput(path).view(owned=True)
+
+
+class StreamSpool(io.RawIOBase):
+    """
+    Seekable file-like object over a non-seekable stream, such as an
+    upload or a pipe, which only reads as much of the stream as has been
+    asked for. What has been read is kept in memory, spilling over to a
+    temporary file on disk past max_size, so that the parsers and
+    generators can seek back within it.
+
+    Seeking relative to the end, and to_path, read the remainder of the
+    stream. Formats which only need the head of the file can therefore
+    be handled without reading all of it, while those which need random
+    access (a PDF, or an MP4 with its index at the end) have the rest
+    spooled as they go.
+
+    If the length of the stream is known in advance, such as from the
+    Content-Length of an upload, it can be provided so that the size of
+    the file can be reported without reading all of it.
+    """
+    chunk_size = 1 << 16
+
+    def __init__(self, source, name=None, length=None, max_size=None):
+        super(StreamSpool, self).__init__()
+        self._source = source
+        self._spool = io.BytesIO()
+        self._spilled = False
+        self._size = 0
+        self._position = 0
+        self._eof = False
+        self.max_size = max_size or MEDIA_STREAM_SPOOL_MAX_SIZE
+        self.name = name or getattr(source, 'name', None) or getattr(source, 'filename', None)
+        self.length = length
+
+    @property
+    def streaming(self):
+        # True as long as some of the stream has not yet been read.
+        return not self._eof
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _spill(self):
+        spool = tempfile.NamedTemporaryFile(suffix=os.path.splitext(self.name or '')[1])
+        spool.write(self._spool.getbuffer())
+        self._spool = spool
+        self._spilled = True
+
+    def _fill(self, end=None):
+        # Read from the stream until end bytes have been spooled, or until
+        # the end of the stream if end is None.
+        while not self._eof and (end is None or self._size < end):
+            chunk = self._source.read(self.chunk_size)
+            if not chunk:
+                self._eof = True
+                if self.length is None:
+                    self.length = self._size
+                break
+            if not self._spilled and self._size + len(chunk) > self.max_size:
+                self._spill()
+            self._spool.seek(self._size)
+            self._spool.write(chunk)
+            self._size += len(chunk)
+
+    def readinto(self, b):
+        self._fill(self._position + len(b))
+        self._spool.seek(self._position)
+        n = self._spool.readinto(b)
+        self._position += n
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill()
+            size = max(0, self._size - self._position)
+        b = bytearray(size)
+        n = self.readinto(b)
+        return bytes(b[:n])
+
+    def readall(self):
+        return self.read()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            self._fill()
+            position = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def tell(self):
+        return self._position
+
+    def forward(self):
+        """
+        Forward-only reader over the stream from the current position,
+        with no seek or tell, for libraries such as FFmpeg which would
+        otherwise seek to the end to find the size of the file. What is
+        read through it is still spooled, so the spool can be rewound
+        afterwards.
+        """
+        return _ForwardReader(self)
+
+    def to_path(self):
+        """
+        Read the remainder of the stream and return the path of a file
+        on disk holding all of it, for libraries which can only work
+        from a path. The file is removed when the spool is closed.
+        """
+        self._fill()
+        if not self._spilled:
+            self._spill()
+        self._spool.flush()
+        return self._spool.name
+
+    def close(self):
+        # The source stream belongs to the caller and is left open.
+        if self.closed:
+            return
+        self._spool.close()
+        super(StreamSpool, self).close()
+
+
+class _ForwardReader(object):
+    def __init__(self, spool):
+        self._spool = spool
+        self.name = spool.name
+
+    def read(self, size=-1):
+        return self._spool.read(size)
+
+
+def is_streaming(file):
+    """
+    Returns True if the file is a StreamSpool over a stream which has not
+    yet been read to the end. Parsers and generators should avoid
+    operations which would read all of it, such as seeking to the end,
+    unless the format requires it.
+    """
+    return getattr(file, 'streaming', False)
+
+
+def stream_input(file, length=None):
+    """
+    Wrap the file in a StreamSpool if it is a file-like object which
+    cannot seek. Other files, and paths, are returned as is. length is
+    the length of the stream, if known. See StreamSpool.
+    """
+    if isinstance(file, str) or isinstance(file, StreamSpool):
+        return file
+    seekable = getattr(file, 'seekable', None)
+    if seekable is not None:
+        try:
+            if seekable():
+                return file
+        except (OSError, ValueError):
+            pass
+    elif hasattr(file, 'seek'):
+        return file
+    return StreamSpool(file, length=length)
+
+
+def open_input(file, length=None):
+    """
+    Open a path or file-like object passed to the parsers and generators.
+    Paths are opened with open_media, and non-seekable streams are
+    wrapped in a StreamSpool, which only reads as far as it needs to.
+    Other file-like objects are used as is. length is passed on to
+    stream_input.
+
+    Returns a tuple of the file and whether it was opened here, in which
+    case the caller is responsible for closing it.
+    """
+    if isinstance(file, str):
+        with instrumentation.stage('open'):
+            return open_media(file), True
+    spooled = stream_input(file, length=length)
+    return spooled, spooled is not file
+
+
+def rewind(file):
+    """
+    Seek the file back to its start if it can seek.
+    """
+    if hasattr(file, 'seekable') and not file.seekable():
+        return
+    file.seek(0)
+
+
+def get_path(file):
+    """
+    Path of the file on disk backing the given path or file-like object,
+    if there is one. Libraries which can read from a path natively
+    (FFmpeg, poppler) should be given this in preference to the
+    file-like object, to avoid reading the file through Python.
+    libmediainfo is not, as its results from a path are not stable. See
+    VideoFileInfoParser._parse_pymediainfo.
+
+    Only views created by this package, and OS level files whose name
+    refers to the very file they have open, are considered to be backed
+    by a path. The name of any other file-like object, such as an upload,
+    need not have anything to do with the files on disk.
+    """
+    if isinstance(file, str):
+        return file
+    if isinstance(file, MediaFileView):
+        return file.path
+    name = getattr(file, 'name', None)
+    if not isinstance(name, str):
+        return None
+    try:
+        fd_stat = os.fstat(file.fileno())
+        name_stat = os.stat(name)
+    except (AttributeError, OSError, ValueError):
+        return None
+    if (fd_stat.st_dev, fd_stat.st_ino) != (name_stat.st_dev, name_stat.st_ino):
+        return None
+    return name
 
 
 @dataclass
 class MediaFileGeneralInfo(object):
     container: str
-    file_size: int
+    file_size: Optional[int]            # Unknown for streams of unknown length
     writing_application: Optional[str]
     internet_media_type: str            # Missing in WebP
 
@@ -32,12 +444,131 @@ def _strip_nones(nested_dict: dict):
     return nested_dict
 
 
+_field_types = {}
+_field_converters = {}
+_compact_classes = {}
+
+# Conversions construct applies to the values of a field, worked out once
+# per class from its type annotation.
+_DECIMAL = 1
+_DATACLASS = 2
+_LIST = 3
+
+
+def _get_field_types(cls):
+    try:
+        return _field_types[cls]
+    except KeyError:
+        hints = typing.get_type_hints(cls)
+        rv = [(f.name, hints[f.name]) for f in fields(cls)]
+        _field_types[cls] = rv
+        return rv
+
+
+def _converter(ftype):
+    # Returns (kind, subclass) for values of the type ftype, with kind None
+    # for values which are used as is. For lists, subclass is the
+    # (kind, subclass) of their items.
+    if typing.get_origin(ftype) is Union:
+        args = [x for x in typing.get_args(ftype) if x is not type(None)]
+        if len(args) == 1:
+            ftype = args[0]
+    if typing.get_origin(ftype) in (list, List):
+        item = _converter(typing.get_args(ftype)[0])
+        if item[0] is None:
+            return None, None
+        return _LIST, item
+    if is_dataclass(ftype):
+        return _DATACLASS, ftype
+    if ftype is Decimal:
+        return _DECIMAL, None
+    return None, None
+
+
+def _get_field_converters(cls):
+    try:
+        return _field_converters[cls]
+    except KeyError:
+        rv = tuple((name,) + _converter(ftype)
+                   for name, ftype in _get_field_types(cls))
+        _field_converters[cls] = rv
+        return rv
+
+
+def compact_class(cls):
+    # Pydantic keeps its validation state in the instance __dict__, so the
+    # info dataclasses themselves can't use __slots__. Instead, we create
+    # a slotted plain dataclass with the same fields, for holding large
+    # numbers of already validated records in memory.
+    # For instances to be picklable, the class needs to be bound to its
+    # name in the module of cls, as is done for the track info classes
+    # at the end of the av module.
+    try:
+        return _compact_classes[cls]
+    except KeyError:
+        field_types = _get_field_types(cls)
+        namespace = {
+            '__slots__': tuple(name for name, _ in field_types),
+            '__annotations__': dict(field_types),
+            '__module__': cls.__module__,
+            '__qualname__': f'Compact{cls.__qualname__}',
+        }
+        rv = plain_dataclass(type(f'Compact{cls.__name__}', (object,), namespace))
+        _compact_classes[cls] = rv
+        return rv
+
+
+def _convert(kind, subclass, value, compact):
+    if kind == _DATACLASS:
+        if isinstance(value, dict):
+            return construct(subclass, value, compact=compact)
+        return value
+    if kind == _DECIMAL:
+        if isinstance(value, Decimal):
+            return value
+        return Decimal(str(value))
+    item_kind, item_subclass = subclass
+    return [x if x is None else _convert(item_kind, item_subclass, x, compact)
+            for x in value]
+
+
+def construct(cls, data, compact=False):
+    """
+    Construct an instance of the info dataclass cls from a dict of already
+    validated data, such as the output of dataclasses.asdict or its JSON
+    round trip, without running pydantic validation or __post_init__.
+
+    If compact is True, nested classes which set _compact (the track info
+    classes) are constructed as their slotted compact_class instead.
+    """
+    values = {}
+    for name, kind, subclass in _get_field_converters(cls):
+        value = data.get(name)
+        if kind is not None and value is not None:
+            value = _convert(kind, subclass, value, compact)
+        values[name] = value
+    if compact and getattr(cls, '_compact', False):
+        return compact_class(cls)(**values)
+    rv = object.__new__(cls)
+    rv.__dict__.update(values)
+    rv.__dict__['__pydantic_initialised__'] = True
+    return rv
+
+
 @dataclass
 class MediaFileInfo(object):
     filename: str
     original_filename: str
     ext: str
 
+    @classmethod
+    def from_dict(cls, data, compact=False):
+        """
+        Fast path for constructing the info from trusted data, such as the
+        output of dataclasses.asdict. Skips all validation. See construct.
+        """
+        return construct(cls, data, compact=compact)
+
     def asdict(self):
         return _strip_nones(asdict(self))
 
@@ -66,7 +597,27 @@ class MediaFileInfoParser(object):
         elif hasattr(file, 'filename'):
             return file.filename
 
-    def _parse(self, file, filename=None, original_filename=None):
+    def _get_size(self, file):
+        try:
+            return os.fstat(file.fileno()).st_size
+        except:
+            pass
+        length = getattr(file, 'length', None)
+        if length is not None:
+            return length
+        if is_streaming(file):
+            # Not worth reading the rest of the stream for
+            return None
+        position = file.tell()
+        file.seek(0, os.SEEK_END)
+        rv = file.tell()
+        file.seek(position)
+        return rv
+
+    def _parse(self, file, filename=None, original_filename=None, **kwargs):
+        # Options specific to the parsers of other types of media are
+        # accepted and ignored here, so they can be passed to
+        # get_media_info regardless of the type of the file.
         if not filename:
             filename = self._get_filename(file)
         rv = {'filename': os.path.split(filename)[-1],
@@ -79,21 +630,110 @@ class MediaFileInfoParser(object):
 
 
 class MediaThumbnailGenerator(object):
-    def pack_and_write(self, size, output_path, image, background):
-        if background:
-            if len(background) == 4 and background[3] < 255:
-                canvas_format = 'RGBA'
+    def _new_canvas(self, size, background):
+        # Imported here to keep importing the parsers and generators cheap.
+        from PIL import Image
+        if len(background) == 4 and background[3] < 255:
+            canvas_format = 'RGBA'
+        else:
+            canvas_format = 'RGB'
+        return Image.new(canvas_format, size, background)
+
+    def pack(self, size, image, background):
+        # Center the image on a canvas of the given size, if there is a
+        # background to fill the canvas with.
+        with instrumentation.stage('pack'):
+            if background:
+                canvas = self._new_canvas(size, background)
+                canvas.paste(image,
+                             (int((size[0] - image.size[0]) / 2),
+                              int((size[1] - image.size[1]) / 2)))
+                return canvas
             else:
-                canvas_format = 'RGB'
-            canvas = Image.new(canvas_format, size, background)
-            canvas.paste(image,
-                         (int((size[0] - image.size[0]) / 2),
-                          int((size[1] - image.size[1]) / 2)))
-            canvas.save(output_path, optimize=True, progressive=True, quality=75)
+                return image.convert('RGB')
+
+    def write(self, output_path, image, encoder=None):
+        # output_path can be a path, or a writable file-like object to
+        # write the encoded image to. If it is None, the encoded image is
+        # returned as bytes instead. The encoder can be a ThumbnailEncoder
+        # or the name of a registered one. If not provided, it is chosen
+        # based on the output path.
+        if encoder:
+            encoder = get_encoder(encoder)
+        elif isinstance(output_path, str):
+            encoder = get_encoder_for_path(output_path)
         else:
-            image.convert('RGB').save(output_path, optimize=True, progressive=True, quality=75)
+            encoder = get_encoder()
+        if output_path is None:
+            buffer = io.BytesIO()
+            with instrumentation.stage('encode'):
+                encoder.save(image, buffer)
+            rv = buffer.getvalue()
+            instrumentation.accumulate(output_bytes=len(rv))
+            return rv
+        with instrumentation.stage('encode'):
+            encoder.save(image, output_path)
+        if isinstance(output_path, str) and instrumentation.enabled():
+            instrumentation.accumulate(output_bytes=os.path.getsize(output_path))
         return output_path
 
-    def generate_thumbnail(self, file, output_path, size, background,
-                           output_format='png'):
+    def pack_and_write(self, size, output_path, image, background, encoder=None):
+        return self.write(output_path, self.pack(size, image, background),
+                          encoder=encoder)
+
+    def _load_image(self, file, size):
+        # Return a PIL Image of the source, decoded at a resolution no
+        # smaller than needed to produce a thumbnail fitting within size.
         raise NotImplementedError
+
+    def _prepare_image(self, image, size):
+        # Prepare an image opened elsewhere for downscaling to size.
+        return image
+
+    def _decode(self, file, size, image=None):
+        # PIL opens images lazily, so the image is loaded here to keep the
+        # decoding out of the resize stage.
+        with instrumentation.stage('decode'):
+            if image is None:
+                image = self._load_image(file, size)
+            else:
+                image = self._prepare_image(image, size)
+            image.load()
+        instrumentation.annotate(decoded_size=image.size)
+        return image
+
+    def generate_thumbnail(self, file, output_path, size, background,
+                           output_format=None, encoder=None):
+        # output_format is accepted as the name of the encoder to use.
+        image = self._decode(file, size)
+        with instrumentation.stage('resize'):
+            image.thumbnail(size)
+        return self.pack_and_write(size, output_path, image, background,
+                                   encoder=encoder or output_format)
+
+    def generate_thumbnails(self, file, targets, background,
+                            output_format=None, image=None, encoder=None):
+        # targets is a list of (size, output_path) tuples. The source is
+        # decoded only once, at the resolution needed by the largest
+        # target, and each subsequent thumbnail is downscaled from the
+        # previous one instead of from the source. If the source has
+        # already been opened as a PIL Image, it can be provided as image.
+        largest = (max(s[0] for s, _ in targets),
+                   max(s[1] for s, _ in targets))
+        image = self._decode(file, largest, image=image)
+
+        def _scale(size):
+            return min(size[0] / image.size[0], size[1] / image.size[1])
+
+        rv = [None] * len(targets)
+        order = sorted(range(len(targets)),
+                       key=lambda i: _scale(targets[i][0]), reverse=True)
+        current = image
+        for idx in order:
+            size, output_path = targets[idx]
+            with instrumentation.stage('resize'):
+                current = current.copy()
+                current.thumbnail(size)
+            rv[idx] = self.pack_and_write(size, output_path, current, background,
+                                          encoder=encoder or output_format)
+        return rv
@@ -0,0 +1,309 @@
+
+
+import os
+import json
+import shutil
+import sqlite3
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import asdict
+from pydantic.json import pydantic_encoder
+
+
+class ThumbnailCache(object):
+    """
+    Content-addressed on-disk cache of generated thumbnails.
+
+    Entries are keyed on a digest of the source content along with the
+    thumbnail size, background, output format and encoder options, so duplicate sources
+    share cache entries regardless of their names. If max_size (in bytes)
+    is set, the least recently used entries are evicted whenever the
+    total size of the cache exceeds it. Other processes may be writing
+    to the same cache directory, so entries and their sizes are read back
+    from disk every sync_interval seconds, as entries are put.
+    """
+    chunk_size = 1 << 20
+    sync_interval = 1.0
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._syncing = False
+        self._recent = set()
+        self._load()
+
+    def __reduce__(self):
+        # Allow the cache to be passed to process pool workers. Each
+        # worker process loads the cache directory once, and resolves
+        # every task's cache to that same instance. See shared_thumbnail_cache.
+        return shared_thumbnail_cache, (self.cache_dir, self.max_size)
+
+    def _scan(self):
+        # Entries on disk, from the least to the most recently used.
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        return OrderedDict((key, size) for _, key, size in sorted(entries))
+
+    def _load(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._entries = self._scan()
+        self._total_size = sum(self._entries.values())
+        self._synced = time.monotonic()
+
+    def _sync(self):
+        # Pick up entries written, used or evicted by other processes. The
+        # directory is scanned without holding the lock, and entries put
+        # by this process in the meantime are carried over.
+        entries = None
+        try:
+            entries = self._scan()
+        finally:
+            with self._lock:
+                if entries is not None:
+                    for key in self._recent:
+                        if key not in entries and key in self._entries:
+                            entries[key] = self._entries[key]
+                    self._entries = entries
+                    self._total_size = sum(entries.values())
+                    self._evict()
+                self._recent = set()
+                self._syncing = False
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def digest(self, file):
+        h = hashlib.sha256()
+        if hasattr(file, 'getbuffer'):
+            # Memory mapped views and BytesIO can be hashed in place
+            h.update(file.getbuffer())
+            return h.hexdigest()
+        file.seek(0)
+        for chunk in iter(lambda: file.read(self.chunk_size), b''):
+            h.update(chunk)
+        file.seek(0)
+        return h.hexdigest()
+
+    def key(self, digest, size, background, output_format, encoding=None):
+        # encoding distinguishes between encoders producing the same
+        # output format with different options. See ThumbnailEncoder.tag
+        if background:
+            background = '-'.join(str(x) for x in background)
+        else:
+            background = 'none'
+        if encoding:
+            background = f'{background}_{encoding}'
+        return f'{digest}_{size[0]}x{size[1]}_{background}.{output_format}'
+
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            if key not in self._entries:
+                # It may have been written by another process
+                try:
+                    size = os.path.getsize(path)
+                except FileNotFoundError:
+                    return None
+                self._entries[key] = size
+                self._total_size += size
+            elif not os.path.exists(path):
+                self._total_size -= self._entries.pop(key)
+                return None
+            self._entries.move_to_end(key)
+        # Persist the recency of the entry for other processes and
+        # for the next time the cache is loaded.
+        os.utime(path)
+        return path
+
+    def put(self, key, source):
+        # source is either the path to the thumbnail or its encoded bytes
+        path = self._path(key)
+        spool = os.path.join(self.cache_dir, f'.{key}.{os.getpid()}.{threading.get_ident()}')
+        if isinstance(source, bytes):
+            with open(spool, 'wb') as f:
+                f.write(source)
+        else:
+            shutil.copyfile(source, spool)
+        os.replace(spool, path)
+        size = os.path.getsize(path)
+        sync = False
+        with self._lock:
+            if key in self._entries:
+                self._total_size -= self._entries.pop(key)
+            self._entries[key] = size
+            self._total_size += size
+            if self._syncing:
+                self._recent.add(key)
+            elif self.max_size and time.monotonic() - self._synced > self.sync_interval:
+                self._syncing = sync = True
+                self._synced = time.monotonic()
+            self._evict()
+        if sync:
+            self._sync()
+        return path
+
+    def _evict(self):
+        # Evict the least recently used entries known to this process.
+        # Entries may already have been evicted by other processes.
+        if not self.max_size:
+            return
+        while self._total_size > self.max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._total_size -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def shared_thumbnail_cache(cache_dir, max_size=None):
+    """
+    Returns the ThumbnailCache for cache_dir and max_size shared within
+    this process, creating it on first use. Used to resolve caches passed
+    to process pool workers, and as the initializer of the pools created
+    by generate_thumbnails_many so that each worker loads the cache once
+    as it starts.
+    """
+    key = (os.path.abspath(cache_dir), max_size)
+    with _shared_caches_lock:
+        if key not in _shared_caches:
+            _shared_caches[key] = ThumbnailCache(cache_dir, max_size)
+        return _shared_caches[key]
+
+
+class MediaInfoCache(object):
+    """
+    Base class for media info cache backends.
+
+    Entries are keyed on the absolute path of the file, along with any
+    parser options such as fast or engine which change the info produced,
+    and are only considered valid as long as the (mtime, size, inode)
+    identity of the file is unchanged. The info is stored as a plain
+    dict, and is rehydrated into the info class of the parser on a hit
+    without validating it again.
+    """
+    def _identity(self, path):
+        stat = os.stat(path)
+        return os.path.abspath(path), (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _key(self, path, options):
+        # Only plain option values are part of the key. Others, such as
+        # an already opened PIL Image, don't change the info produced.
+        options = sorted((k, v) for k, v in (options or {}).items()
+                         if isinstance(v, (str, int, float, bool)))
+        if not options:
+            return path
+        return path + '?' + '&'.join(f'{k}={v!r}' for k, v in options)
+
+    def _get(self, path):
+        raise NotImplementedError
+
+    def _set(self, path, identity, data):
+        raise NotImplementedError
+
+    def _delete(self, path):
+        raise NotImplementedError
+
+    def get(self, path, info_class, options=None):
+        path, identity = self._identity(path)
+        key = self._key(path, options)
+        entry = self._get(key)
+        if not entry:
+            return None
+        if tuple(entry[0]) != identity:
+            self._delete(key)
+            return None
+        return info_class.from_dict(entry[1])
+
+    def set(self, path, info, options=None):
+        path, identity = self._identity(path)
+        self._set(self._key(path, options), identity, asdict(info))
+
+
+class MemoryMediaInfoCache(MediaInfoCache):
+    """
+    In-process media info cache, holding up to maxsize entries and
+    evicting the least recently used entries beyond that. It can't be
+    passed to other processes, such as the workers of a process pool.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __reduce__(self):
+        # A copy in another process would never be seen again by this one.
+        raise TypeError(f"{self.__class__.__name__} is local to the process it "
+                        f"is created in. Use a SqliteMediaInfoCache to share "
+                        f"cached info with other processes.")
+
+    def _get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry:
+                self._entries.move_to_end(path)
+            return entry
+
+    def _set(self, path, identity, data):
+        with self._lock:
+            self._entries[path] = (identity, data)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _delete(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+
+class SqliteMediaInfoCache(MediaInfoCache):
+    """
+    Persistent media info cache in an SQLite database, which can be
+    shared by multiple threads and processes.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS media_info ("
+                         "path TEXT PRIMARY KEY, mtime_ns INTEGER, "
+                         "size INTEGER, inode INTEGER, info TEXT)")
+
+    def __reduce__(self):
+        return self.__class__, (self.db_path,)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _get(self, path):
+        row = self._connection().execute(
+            "SELECT mtime_ns, size, inode, info FROM media_info WHERE path = ?",
+            (path,)).fetchone()
+        if not row:
+            return None
+        return row[:3], json.loads(row[3])
+
+    def _set(self, path, identity, data):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO media_info VALUES (?, ?, ?, ?, ?)",
+                         (path, *identity, json.dumps(data, default=pydantic_encoder)))
+
+    def _delete(self, path):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM media_info WHERE path = ?", (path,))
@@ -1,17 +1,38 @@
 
 
-import os
+import shutil
+import tempfile
+from math import ceil
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 from typing import Literal
 from pypdf import PdfReader
+from pypdf import DocumentInformation
+from pypdf.errors import PyPdfError
 from pydantic.dataclasses import dataclass
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_path
+from tendril import config
+from . import instrumentation
+from .base import rewind
+from .base import get_path
 from .base import MediaFileInfo
 from .base import MediaFileInfoParser
 from .base import MediaFileGeneralInfo
 from .base import MediaThumbnailGenerator
 
 
+# If True, the page count of PDFs is read from the root of the page tree
+# instead of by walking the whole page tree. Much faster on documents
+# with very many pages, but relies on the declared count being correct.
+MEDIA_DOCUMENT_INFO_FAST = getattr(config, 'MEDIA_DOCUMENT_INFO_FAST', False)
+
+# Number of pages previewed by default, and the number of poppler
+# processes and threads used to render and encode multi-page previews.
+MEDIA_DOCUMENT_PREVIEW_PAGES = getattr(config, 'MEDIA_DOCUMENT_PREVIEW_PAGES', 5)
+MEDIA_DOCUMENT_RENDER_THREADS = getattr(config, 'MEDIA_DOCUMENT_RENDER_THREADS', 4)
+
+
 @dataclass
 class DocumentInfo(object):
     pages: int
@@ -45,9 +66,32 @@ class PdfFileInfo(MediaFileInfo):
 class DocumentFileInfoParser(MediaFileInfoParser):
     info_class = PdfFileInfo
 
-    def _parse_document_information(self, reader):
-        rv = {'pages': len(reader.pages)}
+    def __init__(self, fast=None):
+        self.fast = MEDIA_DOCUMENT_INFO_FAST if fast is None else fast
+
+    def _parse_page_count_fast(self, reader):
+        # The page count as declared by the root of the page tree. Only
+        # the objects on the way to it are resolved, instead of the whole
+        # page tree being walked and flattened as len(reader.pages) does.
+        count = reader.trailer['/Root']['/Pages']['/Count']
+        if not isinstance(count, int) or count < 0:
+            raise ValueError(f"Invalid page count {count!r}")
+        return int(count)
+
+    def _parse_document_information(self, reader, fast=False):
+        pages = None
+        if fast:
+            try:
+                pages = self._parse_page_count_fast(reader)
+            except (KeyError, TypeError, ValueError, AttributeError, PyPdfError):
+                # Fall back to counting the pages of the page tree
+                pass
+        if pages is None:
+            pages = len(reader.pages)
+        rv = {'pages': pages}
         metadata = reader.metadata
+        if metadata is None:
+            metadata = DocumentInformation()
         rv['author'] = metadata.author
         rv['creator'] = metadata.creator
         rv['producer'] = metadata.producer
@@ -57,17 +101,10 @@ class DocumentFileInfoParser(MediaFileInfoParser):
         rv['modification_date'] = metadata.modification_date_raw
         return rv
 
-    def _get_size(self, file):
-        try:
-            return os.fstat(file.fileno()).st_size
-        except:
-            file.seek(0, os.SEEK_END)
-            rv = file.tell()
-            file.seek(0)
-            return rv
-
-    def _parse(self, file, *args, **kwargs):
+    def _parse(self, file, *args, fast=None, **kwargs):
         rv = super(DocumentFileInfoParser, self)._parse(file, *args, **kwargs)
+        if fast is None:
+            fast = self.fast
         rv['general'] = {
             'container': "PDF",
             'file_size': self._get_size(file),
@@ -75,17 +112,152 @@ class DocumentFileInfoParser(MediaFileInfoParser):
             'writing_application': None
         }
 
-        reader = PdfReader(file)
-        rv['document'] = self._parse_document_information(reader)
+        # Tolerate broken xref tables and the like rather than bailing
+        # out. pypdf rebuilds what it can and resolves objects lazily.
+        reader = PdfReader(file, strict=False)
+        rv['document'] = self._parse_document_information(reader, fast=fast)
         return rv
 
 
 class DocumentThumbnailGenerator(MediaThumbnailGenerator):
-    def generate_thumbnail(self, file, output_path, size,
-                           background, output_format='png'):
-        file.seek(0)
-        images = convert_from_bytes(file.read(), first_page=1, last_page=1)
-        file.seek(0)
-        image = images[0]
-        image.thumbnail(size)
-        return self.pack_and_write(size, output_path, image, background)
+    def __init__(self, thread_count=None):
+        self.thread_count = thread_count or MEDIA_DOCUMENT_RENDER_THREADS
+
+    def _render_page(self, path, size):
+        # Have poppler render the page directly at the resolution needed
+        # for the largest side of the thumbnail, instead of rendering at
+        # the default 200 DPI and throwing most of the pixels away. The
+        # page is read from the pdftoppm output stream, so no intermediate
+        # image files are written.
+        images = convert_from_path(path, first_page=1, last_page=1,
+                                   size=max(size), single_file=True)
+        return images[0]
+
+    def _page_runs(self, pages):
+        # Split the sorted page numbers into runs of consecutive pages.
+        runs = []
+        for page in pages:
+            if runs and page == runs[-1][1] + 1:
+                runs[-1][1] = page
+            else:
+                runs.append([page, page])
+        return runs
+
+    def _render_pages(self, path, pages, size):
+        # Render each run of consecutive pages requested in a single call,
+        # split across thread_count pdftoppm processes by pdf2image, so
+        # that pages which weren't requested are never rendered. Returns a
+        # list of (page, image) tuples, leaving out pages past the end of
+        # the document.
+        rv = []
+        for first, last in self._page_runs(pages):
+            images = convert_from_path(path, first_page=first, last_page=last,
+                                       size=max(size),
+                                       thread_count=min(self.thread_count, last - first + 1))
+            rv.extend((first + idx, image) for idx, image in enumerate(images))
+            if len(images) < last - first + 1:
+                # Past the end of the document
+                break
+        return rv
+
+    @contextmanager
+    def _document_path(self, file):
+        # Yields a path to the document on disk for poppler to read.
+        path = get_path(file)
+        if path:
+            yield path
+            return
+
+        if hasattr(file, 'to_path'):
+            # Poppler needs random access to the document. Have the
+            # stream spool the rest of itself to disk and render from
+            # there, rather than copying it all over again.
+            yield file.to_path()
+            return
+
+        # There is no file on disk we can point poppler to. Spool the
+        # stream to a temporary file in chunks rather than reading the
+        # whole document into memory.
+        rewind(file)
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as spool:
+            shutil.copyfileobj(file, spool)
+            spool.flush()
+            yield spool.name
+        rewind(file)
+
+    def _load_image(self, file, size):
+        with self._document_path(file) as path:
+            return self._render_page(path, size)
+
+    def resolve_pages(self, pages):
+        if pages is None:
+            pages = range(1, MEDIA_DOCUMENT_PREVIEW_PAGES + 1)
+        pages = sorted(set(pages))
+        if not pages or pages[0] < 1:
+            raise ValueError(f"Invalid pages {pages}, expected page numbers starting from 1")
+        return pages
+
+    def _load_pages(self, file, pages, size):
+        with instrumentation.stage('decode'):
+            with self._document_path(file) as path:
+                return self._render_pages(path, self.resolve_pages(pages), size)
+
+    def generate_page_thumbnails(self, file, targets, size, background,
+                                 encoder=None):
+        """
+        Generate thumbnails of several pages of the document, fitting
+        within size. targets is a list of (page, output_path) tuples, with
+        pages numbered from 1. All the pages are rendered by poppler in a
+        single call, and then downscaled and encoded on a pool of
+        thread_count threads.
+
+        Returns a list of (page, output) tuples in the order of the
+        pages, leaving out pages past the end of the document. See write
+        for the output.
+        """
+        outputs = dict(targets)
+        rendered = self._load_pages(file, list(outputs.keys()), size)
+
+        def _process(item):
+            page, image = item
+            image.thumbnail(size)
+            return page, self.pack_and_write(size, outputs[page], image,
+                                             background, encoder=encoder)
+
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            return list(executor.map(_process, rendered))
+
+    def generate_page_strip(self, file, output_path, tile_size, background,
+                            pages=None, columns=None, encoder=None):
+        """
+        Generate a strip of thumbnails of several pages of the document,
+        by default the first MEDIA_DOCUMENT_PREVIEW_PAGES, each fitted
+        into a tile of tile_size. Tiles are laid out in a single row, or
+        in a grid with the given number of columns.
+
+        Returns a tuple of the output and a list of (page, x, y) tuples
+        with the position of each page in the strip.
+        """
+        background = background or (255, 255, 255)
+        rendered = self._load_pages(file, pages, tile_size)
+        if not rendered:
+            raise Exception("Something strange happened. No pages were rendered!")
+
+        def _process(item):
+            page, image = item
+            image.thumbnail(tile_size)
+            return self.pack(tile_size, image, background)
+
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            tiles = list(executor.map(_process, rendered))
+
+        columns = columns or len(tiles)
+        rows = ceil(len(tiles) / columns)
+        strip = self._new_canvas((columns * tile_size[0], rows * tile_size[1]), background)
+        positions = []
+        for idx, ((page, _), tile) in enumerate(zip(rendered, tiles)):
+            x = (idx % columns) * tile_size[0]
+            y = (idx // columns) * tile_size[1]
+            strip.paste(tile, (x, y))
+            positions.append((page, x, y))
+        return self.write(output_path, strip, encoder=encoder), positions
@@ -0,0 +1,123 @@
+
+
+import os
+import hashlib
+
+from tendril import config
+
+
+# Encoder used for thumbnails, and the encoder used instead when the
+# thumbnail background is translucent and the encoder doesn't support
+# transparency. Names of encoders registered here.
+MEDIA_THUMBNAIL_ENCODER = getattr(config, 'MEDIA_THUMBNAIL_ENCODER', 'jpeg')
+MEDIA_THUMBNAIL_ALPHA_ENCODER = getattr(config, 'MEDIA_THUMBNAIL_ALPHA_ENCODER', 'png')
+
+
+class ThumbnailEncoder(object):
+    """
+    Encodes thumbnails to a particular image format with a particular
+    set of PIL save options.
+    """
+    format = None
+    ext = None
+    supports_alpha = False
+
+    def __init__(self, **options):
+        self.options = options
+
+    @property
+    def tag(self):
+        # Short, stable identifier of the format and options, for use in
+        # cache keys.
+        options = ','.join(f'{k}={v}' for k, v in sorted(self.options.items()))
+        return hashlib.sha1(f'{self.format}:{options}'.encode()).hexdigest()[:8]
+
+    def _prepare(self, image):
+        if image.mode in ('RGB', 'L'):
+            return image
+        if self.supports_alpha and image.mode in ('RGBA', 'LA'):
+            return image
+        return image.convert('RGBA' if self.supports_alpha and 'A' in image.mode else 'RGB')
+
+    def save(self, image, fp):
+        self._prepare(image).save(fp, format=self.format, **self.options)
+
+
+class JpegEncoder(ThumbnailEncoder):
+    format = 'JPEG'
+    ext = 'jpg'
+
+
+class PngEncoder(ThumbnailEncoder):
+    format = 'PNG'
+    ext = 'png'
+    supports_alpha = True
+
+
+class WebpEncoder(ThumbnailEncoder):
+    format = 'WEBP'
+    ext = 'webp'
+    supports_alpha = True
+
+
+class AvifEncoder(ThumbnailEncoder):
+    # Needs a Pillow build with AVIF support, or pillow-avif-plugin.
+    format = 'AVIF'
+    ext = 'avif'
+    supports_alpha = True
+
+
+def _build_encoders():
+    return {
+        # optimize adds an extra pass to build optimal Huffman tables
+        'jpeg': JpegEncoder(optimize=True, progressive=True, quality=75),
+        'jpeg-fast': JpegEncoder(quality=75),
+        'png': PngEncoder(optimize=True),
+        'png-fast': PngEncoder(compress_level=1),
+        # method trades encoding speed (0) for size (6)
+        'webp': WebpEncoder(quality=75, method=4),
+        'webp-fast': WebpEncoder(quality=75, method=0),
+        'avif': AvifEncoder(quality=60, speed=6),
+    }
+
+
+_encoders = _build_encoders()
+
+_encoders_by_ext = {
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.png': 'png',
+    '.webp': 'webp',
+    '.avif': 'avif',
+}
+
+
+def register_encoder(name, encoder: ThumbnailEncoder):
+    _encoders[name] = encoder
+
+
+def get_encoder(encoder=None, background=None):
+    """
+    Get the encoder registered with the given name, or the configured
+    default encoder. ThumbnailEncoder instances are returned as is. If
+    the background is translucent and the encoder can't preserve that,
+    the configured alpha encoder is returned instead.
+
+    Names which aren't registered are looked up as file extensions or
+    format names instead, such as the 'jpg' or 'PNG' output_format the
+    generators accepted before encoders were registered by name.
+    """
+    if not isinstance(encoder, ThumbnailEncoder):
+        name = encoder or MEDIA_THUMBNAIL_ENCODER
+        if name not in _encoders:
+            name = _encoders_by_ext.get('.' + name.lower().lstrip('.'), name)
+        encoder = _encoders[name]
+    if background and len(background) == 4 and background[3] < 255 \
+            and not encoder.supports_alpha:
+        encoder = _encoders[MEDIA_THUMBNAIL_ALPHA_ENCODER]
+    return encoder
+
+
+def get_encoder_for_path(output_path):
+    ext = os.path.splitext(output_path)[1].lower()
+    return _encoders[_encoders_by_ext.get(ext, MEDIA_THUMBNAIL_ENCODER)]
@@ -2,19 +2,28 @@
 
 import warnings
 from PIL import Image
+from PIL import JpegImagePlugin
+from PIL import UnidentifiedImageError
 from typing import List
 from typing import Literal
 from pydantic.dataclasses import dataclass
 from pymediainfo import MediaInfo
 from pymediainfo import Track
 
+from tendril import config
+
 from .av import ImageTrackInfo
+from .base import rewind
 from .base import MediaFileGeneralInfo
 from .base import MediaFileInfo
 from .base import MediaFileInfoParser
 from .base import MediaThumbnailGenerator
 
 
+# Engine used to obtain image info. One of 'pymediainfo' or 'pil'.
+MEDIA_IMAGE_INFO_ENGINE = getattr(config, 'MEDIA_IMAGE_INFO_ENGINE', 'pymediainfo')
+
+
 @dataclass
 class ImageFileInfo(MediaFileInfo):
     general: MediaFileGeneralInfo
@@ -80,9 +89,85 @@ class ImageFileInfoParser(MediaFileInfoParser):
         rv = [self._parse_image_track_information(image_track)]
         return rv
 
-    def _parse(self, file, *args, **kwargs):
+    # PIL format names which differ from those reported by MediaInfo
+    _pil_formats = {
+        'WEBP': 'WebP',
+        'JPEG2000': 'JPEG 2000',
+    }
+
+    _pil_bit_depths = {
+        '1': 1, 'L': 8, 'LA': 8, 'P': 8, 'PA': 8,
+        'RGB': 8, 'RGBA': 8, 'RGBX': 8, 'CMYK': 8, 'YCbCr': 8,
+        'I;16': 16, 'I;16B': 16, 'I;16L': 16, 'I': 32, 'F': 32,
+    }
+
+    _pil_color_spaces = {
+        '1': 'Y', 'L': 'Y', 'LA': 'YA', 'I;16': 'Y', 'I': 'Y', 'F': 'Y',
+        'P': 'RGB', 'PA': 'RGBA', 'RGB': 'RGB', 'RGBA': 'RGBA', 'RGBX': 'RGB',
+        'CMYK': 'CMYK', 'YCbCr': 'YUV',
+    }
+
+    _jpeg_subsamplings = {0: '4:4:4', 1: '4:2:2', 2: '4:2:0'}
+
+    def __init__(self, engine=None):
+        self.engine = engine or MEDIA_IMAGE_INFO_ENGINE
+
+    def _parse_general_information_pil(self, file, image):
+        writing_application = image.info.get('Software') or image.info.get('software')
+        if not writing_application and hasattr(image, 'getexif') and \
+                image.format != 'PNG':
+            # PIL loads the whole of a PNG to look for EXIF data after the
+            # image data, which would defeat reading only the header.
+            writing_application = image.getexif().get(0x0131)
+        rv = {
+            'container': self._pil_formats.get(image.format, image.format),
+            'file_size': self._get_size(file),
+            'writing_application': writing_application,
+            'internet_media_type': Image.MIME.get(image.format)
+        }
+        return rv
+
+    def _parse_image_track_information_pil(self, image):
+        color_space = self._pil_color_spaces.get(image.mode)
+        chroma_subsampling = None
+        if image.format == 'JPEG':
+            if image.mode == 'RGB':
+                # JFIF, stored as YCbCr and converted by libjpeg
+                color_space = 'YUV'
+            sampling = JpegImagePlugin.get_sampling(image)
+            chroma_subsampling = self._jpeg_subsamplings.get(sampling)
+        rv = {
+            'format': self._pil_formats.get(image.format, image.format),
+            'stream_size': None,
+            'format_profile': None,
+            'width': image.size[0],
+            'height': image.size[1],
+            'bit_depth': self._pil_bit_depths.get(image.mode),
+            'color_space': color_space,
+            'chroma_subsampling': chroma_subsampling,
+        }
+        return rv
+
+    def _parse_pil(self, file, image=None):
+        # Reads only the image header. Raises if PIL can't read the
+        # format, in which case we fall back to pymediainfo.
+        if image is None:
+            image = Image.open(file)
+        return {
+            'general': self._parse_general_information_pil(file, image),
+            'image': [self._parse_image_track_information_pil(image)],
+        }
+
+    def _parse(self, file, *args, engine=None, image=None, **kwargs):
         ofname = kwargs.get('original_filename') or kwargs.get('filename')
         rv = super(ImageFileInfoParser, self)._parse(file, *args, **kwargs)
+        if (engine or self.engine) == 'pil':
+            try:
+                rv.update(self._parse_pil(file, image=image))
+                return rv
+            except (UnidentifiedImageError, OSError):
+                rewind(file)
+        # libmediainfo is given the file-like object, as it is in videos.
         mi = MediaInfo.parse(file)
         rv['general'] = self._parse_general_information(mi, fname=ofname)
         rv['image'] = self._parse_image_information(mi, fname=ofname)
@@ -90,8 +175,30 @@ class ImageFileInfoParser(MediaFileInfoParser):
 
 
 class ImageThumbnailGenerator(MediaThumbnailGenerator):
-    def generate_thumbnail(self, file, output_path, size,
-                           background, output_format='png'):
-        image = Image.open(file)
-        image.thumbnail(size)
-        return self.pack_and_write(size, output_path, image, background)
+    # The image is decoded at no less than reducing_gap times the size of
+    # the thumbnail, leaving the rest of the downscale to the resampling
+    # filter. See the reducing_gap parameter of PIL.Image.thumbnail.
+    reducing_gap = 2.0
+
+    def _reduce_on_load(self, image, size):
+        if not getattr(image, 'tile', None):
+            # Already loaded
+            return
+        scale = min(size[0] / image.size[0], size[1] / image.size[1])
+        if scale * self.reducing_gap >= 1:
+            return
+        target = (max(1, int(image.size[0] * scale * self.reducing_gap)),
+                  max(1, int(image.size[1] * scale * self.reducing_gap)))
+        # For JPEGs, libjpeg will downscale in the DCT domain by the
+        # largest power of two which keeps the image larger than the
+        # target. This is a no-op for formats which don't support it, which
+        # are instead reduced by an integer factor by Image.thumbnail as
+        # soon as they are loaded.
+        image.draft(None, target)
+
+    def _prepare_image(self, image, size):
+        self._reduce_on_load(image, size)
+        return image
+
+    def _load_image(self, file, size):
+        return self._prepare_image(Image.open(file), size)
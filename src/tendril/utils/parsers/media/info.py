@@ -1,7 +1,10 @@
 
 
 import os
+import importlib
 
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from typing import Union
 from tendril.config import MEDIA_EXTENSIONS
 from tendril.config import MEDIA_VIDEO_EXTENSIONS
@@ -9,16 +12,43 @@ from tendril.config import MEDIA_IMAGE_EXTENSIONS
 from tendril.config import MEDIA_DOCUMENT_EXTENSIONS
 from tendril.config import MEDIA_EXTRA_EXTENSIONS
 
+from . import instrumentation
+from .aio import spool
+from .aio import run_limited
+from .aio import get_filename
+from .aio import is_async_file
+from .aio import get_media_type
+from .base import open_input
+from .pool import imap_unordered
+from .cache import MediaInfoCache
+from .cache import MemoryMediaInfoCache
+from .base import LazyDispatch
 from .base import MediaFileInfoParser
-from .videos import VideoFileInfoParser
-from .images import ImageFileInfoParser
-from .documents import DocumentFileInfoParser
 
-from .videos import VideoFileInfo
-from .images import ImageFileInfo
-from .documents import PdfFileInfo
 
-MediaInfoTModel = Union[VideoFileInfo, ImageFileInfo, PdfFileInfo]
+# The info and parser classes, which used to be imported along with this
+# module, and the modules they are now imported from on first access.
+_lazy_names = {
+    'VideoFileInfo': '.videos',
+    'VideoFileInfoParser': '.videos',
+    'ImageFileInfo': '.images',
+    'ImageFileInfoParser': '.images',
+    'PdfFileInfo': '.documents',
+    'DocumentFileInfoParser': '.documents',
+}
+
+
+def __getattr__(name):
+    # The info classes are only imported when they or MediaInfoTModel are
+    # used, to avoid importing the media libraries along with this module.
+    if name == 'MediaInfoTModel':
+        from .videos import VideoFileInfo
+        from .images import ImageFileInfo
+        from .documents import PdfFileInfo
+        return Union[VideoFileInfo, ImageFileInfo, PdfFileInfo]
+    if name in _lazy_names:
+        return getattr(importlib.import_module(_lazy_names[name], __package__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class ExtraMediaFileInfoParser(MediaFileInfoParser):
@@ -26,40 +56,115 @@ class ExtraMediaFileInfoParser(MediaFileInfoParser):
 
 
 def _build_parsers():
-    rv = {}
-    for parser, exts in [
+    # Parser modules, and the media libraries they use, are only
+    # imported on first use of an extension they handle.
+    return LazyDispatch(__package__, [
         (MediaFileInfoParser(), MEDIA_EXTENSIONS),
-        (VideoFileInfoParser(), MEDIA_VIDEO_EXTENSIONS),
-        (ImageFileInfoParser(), MEDIA_IMAGE_EXTENSIONS),
-        (DocumentFileInfoParser(), MEDIA_DOCUMENT_EXTENSIONS),
+        ('.videos:VideoFileInfoParser', MEDIA_VIDEO_EXTENSIONS),
+        ('.images:ImageFileInfoParser', MEDIA_IMAGE_EXTENSIONS),
+        ('.documents:DocumentFileInfoParser', MEDIA_DOCUMENT_EXTENSIONS),
         (ExtraMediaFileInfoParser(), MEDIA_EXTRA_EXTENSIONS)
-    ]:
-        for ext in exts:
-            rv[ext] = parser
-    return rv
+    ])
 
 
 _parsers = _build_parsers()
 
 
-def get_media_info(file, filename=None, original_filename=None):
-    _to_close = False
-    if isinstance(file, str):
+def get_media_info(file, filename=None, original_filename=None,
+                   cache: MediaInfoCache = None, length=None, **kwargs):
+    # Any additional keyword arguments are passed on to the parser, and
+    # are ignored by parsers which don't use them. See, for instance,
+    # the engine option of ImageFileInfoParser. length is the length of
+    # a non-seekable stream, if known, which is otherwise only reported
+    # as the file size if the stream had to be read to the end anyway.
+    with instrumentation.call('info'):
+        return _get_media_info(file, filename=filename,
+                               original_filename=original_filename,
+                               cache=cache, length=length, **kwargs)
+
+
+def _get_media_info(file, filename=None, original_filename=None,
+                    cache: MediaInfoCache = None, length=None, **kwargs):
+    _from_path = isinstance(file, str)
+    if _from_path:
         filename = file
-        file = open(file, 'rb')
-        _to_close = True
+        if cache:
+            parser = _parsers[os.path.splitext(filename)[1]]
+            rv = cache.get(file, parser.info_class, options=kwargs)
+            if rv:
+                rv.original_filename = original_filename
+                instrumentation.annotate(cache_hit=True)
+                return rv
+
+    file, _to_close = open_input(file, length=length)
+    try:
+        if not filename:
+            if hasattr(file, 'filename'):
+                filename = file.filename
+            else:
+                filename = file.name
+
+        if instrumentation.enabled():
+            instrumentation.annotate(filename=filename,
+                                     input_bytes=instrumentation.source_size(file))
+
+        parser = _parsers[os.path.splitext(filename)[1]]
+        with instrumentation.stage('parse'):
+            rv = parser.parse(file, filename=filename,
+                              original_filename=original_filename, **kwargs)
+    finally:
+        if _to_close:
+            file.close()
+
+    if cache and _from_path:
+        cache.set(filename, rv, options=kwargs)
 
-    if not filename:
-        if hasattr(file, 'filename'):
-            filename = file.filename
-        else:
-            filename = file.name
+    return rv
 
-    parser = _parsers[os.path.splitext(filename)[1]]
-    rv = parser.parse(file, filename=filename,
-                      original_filename=original_filename)
 
-    if _to_close:
-        file.close()
+def get_media_info_many(paths, workers=None, executor=None, **kwargs):
+    """
+    Get the media info for each of the given paths, parsing them in
+    parallel on a pool of workers. By default, a process pool with the
+    given number of workers is used. Any concurrent.futures executor can
+    be provided instead.
+
+    Yields (path, info) tuples in the order in which the files complete.
+    If parsing a file fails, the exception is yielded in place of its
+    info instead of aborting the batch.
+
+    A MemoryMediaInfoCache can only be used with a thread pool executor.
+    """
+    if isinstance(kwargs.get('cache'), MemoryMediaInfoCache) and \
+            (executor is None or isinstance(executor, ProcessPoolExecutor)):
+        raise ValueError("A MemoryMediaInfoCache can't be shared with the "
+                         "workers of a process pool. Provide a thread pool "
+                         "executor, or use a SqliteMediaInfoCache.")
+    return imap_unordered(partial(get_media_info, **kwargs), paths,
+                          workers=workers, executor=executor)
+
+
+async def get_media_info_async(file, filename=None, original_filename=None,
+                               cache: MediaInfoCache = None, **kwargs):
+    """
+    Asynchronous variant of get_media_info. The file can be a path, a
+    regular file-like object or an async file-like object. Parsing runs
+    on the shared executor of the aio module, within the concurrency
+    limit for the type of media.
+    """
+    if not filename:
+        filename = get_filename(file)
 
-    return rv
+    _to_close = False
+    if is_async_file(file):
+        file = await spool(file)
+        _to_close = True
+
+    try:
+        return await run_limited(get_media_type(os.path.splitext(filename)[1]),
+                                 get_media_info, file, filename=filename,
+                                 original_filename=original_filename,
+                                 cache=cache, **kwargs)
+    finally:
+        if _to_close:
+            file.close()
@@ -0,0 +1,282 @@
+
+"""
+Instrumentation of the info parsing and thumbnail generation hot paths.
+
+Each call to get_media_info, generate_thumbnail or generate_thumbnails
+produces a CallRecord with the time spent in each of its stages (open,
+parse, decode, resize, pack and encode), the size of the source and of
+the encoded output, and the dimensions of the decoded image. Finished
+records are passed to each of the registered hooks :
+
+    aggregator = HistogramAggregator()
+    add_hook(aggregator)
+    ...
+    print(aggregator.summary())
+
+When no hooks are registered, nothing is recorded and the stages reduce
+to a shared no-op context manager.
+
+Records are only collected in the thread, task or process the call runs
+in. Hooks registered in the parent process do not see calls made in
+process pool workers.
+"""
+
+import os
+import math
+import time
+import threading
+from contextvars import ContextVar
+from dataclasses import field
+from dataclasses import dataclass
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+
+_hooks = []
+_hooks_lock = threading.Lock()
+_current = ContextVar('media_instrumentation_record', default=None)
+
+
+@dataclass
+class CallRecord(object):
+    operation: str
+    duration: float = 0.0
+    stages: Dict[str, float] = field(default_factory=dict)
+    counts: Dict[str, int] = field(default_factory=dict)
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[BaseException] = None
+
+
+def add_hook(hook):
+    """
+    Register a callable to be called with the CallRecord of each
+    instrumented call once it completes.
+    """
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+def enabled():
+    """
+    Returns True if the current call is being recorded. Use to guard
+    annotations which are expensive to compute.
+    """
+    return _current.get() is not None
+
+
+class _NullContext(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_null = _NullContext()
+
+
+class _Call(object):
+    __slots__ = ('record', 'start', 'token')
+
+    def __init__(self, operation):
+        self.record = CallRecord(operation=operation)
+
+    def __enter__(self):
+        self.token = _current.set(self.record)
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.record.duration = time.perf_counter() - self.start
+        self.record.error = exc_val
+        _current.reset(self.token)
+        for hook in list(_hooks):
+            hook(self.record)
+        return False
+
+
+class _Stage(object):
+    __slots__ = ('record', 'name', 'start')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self.start
+        stages = self.record.stages
+        stages[self.name] = stages.get(self.name, 0.0) + elapsed
+        counts = self.record.counts
+        counts[self.name] = counts.get(self.name, 0) + 1
+        return False
+
+
+def call(operation):
+    """
+    Context manager wrapping an instrumented call. Stages entered within
+    it are recorded against it, and its record is passed to the hooks
+    when it exits. A no-op if no hooks are registered.
+    """
+    if not _hooks:
+        return _null
+    return _Call(operation)
+
+
+def stage(name):
+    """
+    Context manager timing a stage of the current call. Stages with the
+    same name entered more than once in a call, such as the encoding of
+    each of several thumbnails, are accumulated.
+    """
+    record = _current.get()
+    if record is None:
+        return _null
+    return _Stage(record, name)
+
+
+def annotate(**kwargs):
+    """
+    Attach attributes to the record of the current call, if any.
+    """
+    record = _current.get()
+    if record is not None:
+        record.attributes.update(kwargs)
+
+
+def accumulate(**kwargs):
+    """
+    Add to numeric attributes of the record of the current call, if any,
+    such as the output bytes of each of several thumbnails.
+    """
+    record = _current.get()
+    if record is not None:
+        attributes = record.attributes
+        for key, value in kwargs.items():
+            attributes[key] = attributes.get(key, 0) + value
+
+
+def source_size(file):
+    """
+    Best effort size in bytes of a source file-like object, for
+    annotating records. Returns None if it cannot be determined without
+    reading the file.
+    """
+    if hasattr(file, 'getbuffer'):
+        return file.getbuffer().nbytes
+    try:
+        return os.fstat(file.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class HistogramAggregator(object):
+    """
+    Hook aggregating the durations of calls and their stages into
+    in-process histograms with logarithmically spaced buckets, keyed on
+    (operation, stage). The duration of the call as a whole is recorded
+    under the stage 'total'. Sizes and dimensions are accumulated as
+    totals, for working out throughput.
+    """
+    min_value = 1e-5
+    buckets_per_decade = 10
+    decades = 7
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._totals = {}
+
+    def _bucket(self, value):
+        if value <= self.min_value:
+            return 0
+        idx = int(math.log10(value / self.min_value) * self.buckets_per_decade) + 1
+        return min(idx, self.buckets_per_decade * self.decades)
+
+    def _bucket_value(self, idx):
+        # Upper bound of the bucket
+        return self.min_value * 10 ** (idx / self.buckets_per_decade)
+
+    def _add(self, key, value):
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                                 'buckets': {}}
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['max'] = max(histogram['max'], value)
+        idx = self._bucket(value)
+        histogram['buckets'][idx] = histogram['buckets'].get(idx, 0) + 1
+
+    def __call__(self, record: CallRecord):
+        with self._lock:
+            self._add((record.operation, 'total'), record.duration)
+            for name, duration in record.stages.items():
+                self._add((record.operation, name), duration)
+            totals = self._totals.setdefault(record.operation, {
+                'calls': 0, 'errors': 0, 'input_bytes': 0, 'output_bytes': 0,
+                'decoded_pixels': 0})
+            totals['calls'] += 1
+            if record.error is not None:
+                totals['errors'] += 1
+            attributes = record.attributes
+            totals['input_bytes'] += attributes.get('input_bytes') or 0
+            totals['output_bytes'] += attributes.get('output_bytes') or 0
+            decoded = attributes.get('decoded_size')
+            if decoded:
+                totals['decoded_pixels'] += decoded[0] * decoded[1]
+
+    def _percentile(self, histogram, p):
+        target = p / 100 * histogram['count']
+        seen = 0
+        for idx in sorted(histogram['buckets']):
+            seen += histogram['buckets'][idx]
+            if seen >= target:
+                return min(self._bucket_value(idx), histogram['max'])
+        return histogram['max']
+
+    def percentile(self, operation, stage, p):
+        """
+        Estimate of the p-th percentile duration of the given stage, as
+        the upper bound of the bucket it falls in.
+        """
+        with self._lock:
+            histogram = self._histograms.get((operation, stage))
+            if not histogram:
+                return None
+            return self._percentile(histogram, p)
+
+    def summary(self):
+        """
+        Returns a dict of operation to a dict of its totals, and of the
+        count, mean, p50, p90, p99 and max duration of each of its stages.
+        """
+        with self._lock:
+            rv = {operation: {'totals': dict(totals), 'stages': {}}
+                  for operation, totals in self._totals.items()}
+            for (operation, name), histogram in self._histograms.items():
+                rv[operation]['stages'][name] = {
+                    'count': histogram['count'],
+                    'mean': histogram['sum'] / histogram['count'],
+                    'p50': self._percentile(histogram, 50),
+                    'p90': self._percentile(histogram, 90),
+                    'p99': self._percentile(histogram, 99),
+                    'max': histogram['max'],
+                }
+        return rv
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._totals = {}
@@ -0,0 +1,60 @@
+
+
+import os
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _max_workers(executor):
+    return getattr(executor, '_max_workers', None) or os.cpu_count() or 1
+
+
+def imap_unordered(fn, items, workers=None, executor=None, max_in_flight=None,
+                   initializer=None, initargs=()):
+    """
+    Apply fn to each of the items on a pool of workers, yielding
+    (item, result) tuples in the order in which they complete.
+
+    If fn raises for an item, the exception is yielded in place of the
+    result and the remaining items are processed as usual.
+
+    If no executor is provided, a ProcessPoolExecutor with the given
+    number of workers is created for the duration of the iteration. In
+    that case, fn, the items and the results all need to be picklable.
+    No more than max_in_flight items (by default, twice the number of
+    workers) are submitted to the executor at any time, so items are
+    consumed lazily as workers become available. initializer and
+    initargs are passed on to the ProcessPoolExecutor, if one is created.
+    """
+    _own_executor = False
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                                       initargs=initargs)
+        _own_executor = True
+
+    if not max_in_flight:
+        max_in_flight = 2 * _max_workers(executor)
+
+    def _collect(pending, return_when):
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            item = pending.pop(future)
+            try:
+                yield item, future.result()
+            except Exception as e:
+                yield item, e
+
+    pending = {}
+    try:
+        for item in items:
+            pending[executor.submit(fn, item)] = item
+            if len(pending) >= max_in_flight:
+                yield from _collect(pending, FIRST_COMPLETED)
+        while pending:
+            yield from _collect(pending, FIRST_COMPLETED)
+    finally:
+        for future in pending:
+            future.cancel()
+        if _own_executor:
+            executor.shutdown(wait=True)
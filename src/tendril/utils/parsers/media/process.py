@@ -0,0 +1,127 @@
+
+
+import os
+import shutil
+import tempfile
+
+from tendril.config import MEDIA_VIDEO_EXTENSIONS
+from tendril.config import MEDIA_IMAGE_EXTENSIONS
+from tendril.config import MEDIA_THUMBNAIL_BACKGROUND
+
+from .aio import SPOOL_MAX_SIZE
+from .aio import get_filename
+from .base import open_media
+from .base import stream_input
+from .info import get_media_info
+from .thumbnails import _generators
+from .thumbnails import generate_thumbnails
+
+
+def _open_image(file, fext):
+    if fext not in MEDIA_IMAGE_EXTENSIONS:
+        return None
+    from PIL import Image
+    from PIL import UnidentifiedImageError
+    try:
+        return Image.open(file)
+    except (UnidentifiedImageError, OSError):
+        # Formats PIL can't read, such as SVG
+        return None
+
+
+def _open_container(file, fext, engine):
+    # Videos parsed with the 'pyav' engine share a single container
+    # between the info parser and the thumbnail frame.
+    if fext not in MEDIA_VIDEO_EXTENSIONS:
+        return None, None
+    from .videos import MEDIA_VIDEO_INFO_ENGINE
+    generator = _generators.get(fext)
+    if (engine or MEDIA_VIDEO_INFO_ENGINE) != 'pyav' or \
+            not hasattr(generator, 'load_keyframe'):
+        return None, None
+    return generator, generator.open_container(file)
+
+
+def process_media(file, output_dir=None, sizes=None, filename=None,
+                  original_filename=None,
+                  background=MEDIA_THUMBNAIL_BACKGROUND,
+                  spool=False, length=None, **kwargs):
+    """
+    Get the media info of the file and generate its thumbnails in one go,
+    sharing a single open handle between the info parser and the
+    thumbnail generator. For images, the PIL header is read once and the
+    opened image reused for the thumbnails, as well as for the info when
+    using the 'pil' image info engine. Any additional keyword arguments
+    are passed on to get_media_info.
+
+    For videos with the 'pyav' info engine, a single PyAV container is
+    opened, from which both the info and the thumbnail frame are read.
+    Otherwise, a file on disk is not read only once. libmediainfo reads
+    it through the memory mapped view, and FFmpeg and poppler are given
+    its path and each read the file itself. So for videos with the
+    'pymediainfo' engine, for documents, and for images with the
+    'pymediainfo' engine, the info and the thumbnails each read the file.
+
+    If spool is True, the file is read exactly once, into a temporary
+    file held in memory up to SPOOL_MAX_SIZE and spilled to local disk
+    beyond that, from which both passes then read. Use this for files on
+    network-mounted storage, where reading the file twice is costlier
+    than spooling it. length is the length of a non-seekable stream, if
+    known. See StreamSpool.
+
+    Returns a tuple of the media info and the list of (size, output_path)
+    tuples returned by generate_thumbnails. If output_dir is None, the
+    thumbnails are not written to disk and their encoded bytes are
+    returned in place of the output paths.
+    """
+    _to_close = False
+    if isinstance(file, str):
+        filename = file
+        file = open_media(file)
+        _to_close = True
+
+    if not filename:
+        filename = get_filename(file)
+
+    if not spool and not _to_close:
+        # Non-seekable streams are spooled as they are read, so that both
+        # passes can read them, without reading more than they need.
+        spooled = stream_input(file, length=length)
+        _to_close = spooled is not file
+        file = spooled
+
+    if spool:
+        source = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        shutil.copyfileobj(file, source)
+        source.seek(0)
+        if _to_close:
+            file.close()
+        file = source
+        _to_close = True
+
+    fext = os.path.splitext(filename)[1]
+
+    try:
+        image = _open_image(file, fext)
+        file.seek(0)
+        generator, container = _open_container(file, fext, kwargs.get('engine'))
+        try:
+            info = get_media_info(file, filename=filename,
+                                  original_filename=original_filename,
+                                  image=image, container=container, **kwargs)
+            if container is not None:
+                # Decoded from the container before the file is seeked,
+                # as FFmpeg may still be reading from it.
+                image = generator.load_keyframe(file, container=container)
+        finally:
+            if container is not None:
+                container.close()
+        file.seek(0)
+        thumbnails = generate_thumbnails(file, output_dir, filename=filename,
+                                         sizes=sizes, background=background,
+                                         image=image)
+    finally:
+        if _to_close:
+            file.close()
+
+    return info, thumbnails
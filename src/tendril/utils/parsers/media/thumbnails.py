@@ -2,6 +2,8 @@
 
 import os
 import warnings
+import importlib
+from functools import partial
 from typing import Union
 from typing import Tuple
 from tendril.config import MEDIA_VIDEO_EXTENSIONS
@@ -10,76 +12,467 @@ from tendril.config import MEDIA_DOCUMENT_EXTENSIONS
 from tendril.config import MEDIA_THUMBNAIL_SIZES
 from tendril.config import MEDIA_THUMBNAIL_BACKGROUND
 
-from .images import ImageThumbnailGenerator
-from .videos import VideoThumbnailGenerator
-from .documents import DocumentThumbnailGenerator
+from . import instrumentation
+from .aio import spool
+from .aio import run_limited
+from .aio import get_filename
+from .aio import is_async_file
+from .aio import get_media_type
+from .base import open_input
+from .pool import imap_unordered
+from .cache import ThumbnailCache
+from .cache import shared_thumbnail_cache
+from .encoders import get_encoder
+from .encoders import ThumbnailEncoder
+from .base import LazyDispatch
 
 
-def _build_generators():
-    rv = {}
-    for generator, exts in [
-        (VideoThumbnailGenerator(), MEDIA_VIDEO_EXTENSIONS),
-        (ImageThumbnailGenerator(), MEDIA_IMAGE_EXTENSIONS),
-        (DocumentThumbnailGenerator(), MEDIA_DOCUMENT_EXTENSIONS),
-    ]:
-        for ext in exts:
-            rv[ext] = generator
-    return rv
+# The generator classes, which used to be imported along with this module,
+# and the modules they are now imported from on first access.
+_lazy_names = {
+    'VideoThumbnailGenerator': '.videos',
+    'ImageThumbnailGenerator': '.images',
+    'DocumentThumbnailGenerator': '.documents',
+}
 
 
-_generators = _build_generators()
+def __getattr__(name):
+    # Avoids importing the media libraries along with this module.
+    if name in _lazy_names:
+        return getattr(importlib.import_module(_lazy_names[name], __package__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-def generate_thumbnail(file, output_dir, filename=None,
-                       size: Union[int, Tuple[int]] = 256,
-                       output_fname=None,
-                       background=MEDIA_THUMBNAIL_BACKGROUND):
-    _to_close = False
-    if isinstance(file, str):
-        file = open(file, 'rb')
-        _to_close = True
-        filename = file.name
+def _build_generators():
+    # Generator modules, and the media libraries they use, are only
+    # imported on first use of an extension they handle.
+    return LazyDispatch(__package__, [
+        ('.videos:VideoThumbnailGenerator', MEDIA_VIDEO_EXTENSIONS),
+        ('.images:ImageThumbnailGenerator', MEDIA_IMAGE_EXTENSIONS),
+        ('.documents:DocumentThumbnailGenerator', MEDIA_DOCUMENT_EXTENSIONS),
+    ])
 
-    fname, fext = os.path.splitext(os.path.split(filename)[1])
 
-    if background and len(background) == 4 and background[3] < 255:
-        output_format = 'png'
-    else:
-        output_format = 'jpg'
+_generators = _build_generators()
+
 
+def _get_output_path(output_dir, fname, fext, size, output_format,
+                     output_fname=None):
     if not output_fname:
         if isinstance(size, int):
             output_fname = f'{fname}{fext.replace(".", "_")}_thumb_{size}.{output_format}'
         else:
             output_fname = f'{fname}{fext.replace(".", "_")}_thumb_{size[0]}x{size[1]}.{output_format}'
+    return os.path.join(output_dir, output_fname)
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
 
-    output_path = os.path.join(output_dir, output_fname)
+def _deliver(data, output):
+    # Write encoded thumbnail data to the output buffer if there is one,
+    # else return it as is.
+    if output is None:
+        return data
+    output.write(data)
+    return output
 
+
+def _read_cached(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _get_generator(fext):
     try:
-        generator = _generators[fext]
+        return _generators[fext]
     except KeyError:
         warnings.warn(f"Generator for extension {fext} not installed. "
                       f"No thumbnail will be generated.")
         return None
 
-    if not isinstance(size, tuple):
-        size = (size, size)
 
-    outpath = generator.generate_thumbnail(file, output_path, size=size,
-                                           background=background)
+def generate_thumbnail(file, output_dir=None, filename=None,
+                       size: Union[int, Tuple[int]] = 256,
+                       output_fname=None,
+                       background=MEDIA_THUMBNAIL_BACKGROUND,
+                       cache: ThumbnailCache = None,
+                       encoder: Union[str, ThumbnailEncoder] = None,
+                       output=None, length=None):
+    """
+    Generate a thumbnail of the file fitting within size, and write it
+    to output_dir. Returns a tuple of the size and the output path.
+
+    If output_dir is None, nothing is written to disk. The encoded
+    thumbnail is written to the output file-like object if one is
+    provided, and returned in place of the output path. Otherwise,
+    the encoded bytes are returned in place of the output path.
+
+    length is the length of the file, if it is a non-seekable stream and
+    the length is known. See StreamSpool.
+    """
+    with instrumentation.call('thumbnail'):
+        return _generate_thumbnail(file, output_dir=output_dir,
+                                   filename=filename, size=size,
+                                   output_fname=output_fname,
+                                   background=background, cache=cache,
+                                   encoder=encoder, output=output,
+                                   length=length)
+
 
-    if _to_close:
-        file.close()
+def _generate_thumbnail(file, output_dir=None, filename=None,
+                        size: Union[int, Tuple[int]] = 256,
+                        output_fname=None,
+                        background=MEDIA_THUMBNAIL_BACKGROUND,
+                        cache: ThumbnailCache = None,
+                        encoder: Union[str, ThumbnailEncoder] = None,
+                        output=None, length=None):
+    if isinstance(file, str):
+        filename = file
+    file, _to_close = open_input(file, length=length)
+    try:
+        if not filename:
+            filename = file.name
+
+        if instrumentation.enabled():
+            instrumentation.annotate(filename=filename,
+                                     input_bytes=instrumentation.source_size(file))
+
+        fname, fext = os.path.splitext(os.path.split(filename)[1])
+        encoder = get_encoder(encoder, background)
+        output_format = encoder.ext
+
+        in_memory = output_dir is None
+        if in_memory:
+            output_path = output
+        else:
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir, exist_ok=True)
+            output_path = _get_output_path(output_dir, fname, fext, size,
+                                           output_format, output_fname)
+
+        generator = _get_generator(fext)
+        if not generator:
+            return None
+
+        if not isinstance(size, tuple):
+            size = (size, size)
+
+        if cache:
+            key = cache.key(cache.digest(file), size, background, output_format,
+                            encoding=encoder.tag)
+            outpath = cache.get(key)
+            if outpath:
+                instrumentation.annotate(cache_hit=True)
+                if in_memory:
+                    return size, _deliver(_read_cached(outpath), output)
+                return size, outpath
+
+        if in_memory and cache:
+            data = generator.generate_thumbnail(file, None, size=size,
+                                                background=background,
+                                                encoder=encoder)
+            cache.put(key, data)
+            outpath = _deliver(data, output)
+        else:
+            outpath = generator.generate_thumbnail(file, output_path, size=size,
+                                                   background=background,
+                                                   encoder=encoder)
+            if cache:
+                cache.put(key, outpath)
+    finally:
+        if _to_close:
+            file.close()
 
     return size, outpath
 
 
-def generate_thumbnails(file, output_dir, filename=None, background=MEDIA_THUMBNAIL_BACKGROUND):
-    rv = []
-    for size in MEDIA_THUMBNAIL_SIZES:
-        rv.append(generate_thumbnail(file, output_dir, filename=filename,
-                                     size=size, background=background))
-    return rv
+def generate_thumbnails(file, output_dir=None, filename=None,
+                        background=MEDIA_THUMBNAIL_BACKGROUND, sizes=None,
+                        cache: ThumbnailCache = None, image=None,
+                        encoder: Union[str, ThumbnailEncoder] = None,
+                        length=None):
+    """
+    Generate thumbnails of the file for each of the given sizes, or for
+    each of the configured MEDIA_THUMBNAIL_SIZES if sizes is not provided.
+
+    Unlike calling generate_thumbnail once per size, the source is only
+    opened and decoded once. Returns a list of (size, output_path)
+    tuples in the same order as sizes. If output_dir is None, nothing is
+    written to disk and the encoded bytes of each thumbnail are returned
+    in place of the output paths.
+
+    If a cache is provided, sizes already in the cache are not generated
+    again and the paths to the cached thumbnails are returned for them.
+
+    If the file has already been opened as a PIL Image, it can be
+    provided as image to avoid opening it again. length is as for
+    generate_thumbnail.
+    """
+    with instrumentation.call('thumbnails'):
+        return _generate_thumbnails(file, output_dir=output_dir,
+                                    filename=filename, background=background,
+                                    sizes=sizes, cache=cache, image=image,
+                                    encoder=encoder, length=length)
+
+
+def _generate_thumbnails(file, output_dir=None, filename=None,
+                         background=MEDIA_THUMBNAIL_BACKGROUND, sizes=None,
+                         cache: ThumbnailCache = None, image=None,
+                         encoder: Union[str, ThumbnailEncoder] = None,
+                         length=None):
+    if sizes is None:
+        sizes = MEDIA_THUMBNAIL_SIZES
+
+    if isinstance(file, str):
+        filename = file
+    file, _to_close = open_input(file, length=length)
+    try:
+        if not filename:
+            filename = file.name
+
+        if instrumentation.enabled():
+            instrumentation.annotate(filename=filename,
+                                     input_bytes=instrumentation.source_size(file))
+
+        fname, fext = os.path.splitext(os.path.split(filename)[1])
+        encoder = get_encoder(encoder, background)
+        output_format = encoder.ext
+
+        generator = _get_generator(fext)
+        if not generator:
+            return [None for _ in sizes]
+
+        in_memory = output_dir is None
+        if not in_memory and not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+
+        targets = []
+        for size in sizes:
+            if in_memory:
+                output_path = None
+            else:
+                output_path = _get_output_path(output_dir, fname, fext, size, output_format)
+            if not isinstance(size, tuple):
+                size = (size, size)
+            targets.append((size, output_path))
+
+        outpaths = [None] * len(targets)
+        if cache:
+            digest = cache.digest(file)
+            keys = [cache.key(digest, size, background, output_format,
+                              encoding=encoder.tag)
+                    for size, _ in targets]
+            outpaths = [cache.get(key) for key in keys]
+            if in_memory:
+                outpaths = [_read_cached(x) if x else None for x in outpaths]
+            instrumentation.annotate(cache_hits=sum(1 for x in outpaths if x))
+
+        missing = [idx for idx, outpath in enumerate(outpaths) if not outpath]
+        if missing:
+            generated = generator.generate_thumbnails(
+                file, [targets[idx] for idx in missing], background=background,
+                image=image, encoder=encoder)
+            for idx, outpath in zip(missing, generated):
+                outpaths[idx] = outpath
+                if cache:
+                    cache.put(keys[idx], outpath)
+    finally:
+        if _to_close:
+            file.close()
+
+    return [(size, outpath) for (size, _), outpath in zip(targets, outpaths)]
+
+
+def generate_sprite_sheet(file, output_dir, filename=None,
+                          tile_size: Tuple[int] = (160, 90),
+                          interval=10, columns=None, max_tiles=100,
+                          index_format='vtt',
+                          background=MEDIA_THUMBNAIL_BACKGROUND,
+                          encoder: Union[str, ThumbnailEncoder] = None):
+    """
+    Generate a sprite sheet of frames of a video, along with a WebVTT or
+    JSON index of its tiles, for use in scrubber previews. See
+    VideoThumbnailGenerator.generate_sprite_sheet.
+
+    Returns a tuple of the paths to the sprite sheet and its index, or
+    None if the file is not a video.
+    """
+    if isinstance(file, str):
+        filename = file
+    file, _to_close = open_input(file)
+    try:
+        if not filename:
+            filename = file.name
+
+        fname, fext = os.path.splitext(os.path.split(filename)[1])
+        encoder = get_encoder(encoder, background)
+        output_format = encoder.ext
+
+        generator = _get_generator(fext)
+        if not hasattr(generator, 'generate_sprite_sheet'):
+            warnings.warn(f"Sprite sheets are not supported for extension {fext}.")
+            return None
+
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+
+        prefix = f'{fname}{fext.replace(".", "_")}_sprite_{tile_size[0]}x{tile_size[1]}'
+        output_path = os.path.join(output_dir, f'{prefix}.{output_format}')
+        index_path = os.path.join(output_dir, f'{prefix}.{index_format}')
+
+        return generator.generate_sprite_sheet(
+            file, output_path, tile_size, background,
+            interval=interval, columns=columns, max_tiles=max_tiles,
+            index_path=index_path, index_format=index_format,
+            encoder=encoder)
+    finally:
+        if _to_close:
+            file.close()
+
+
+def generate_page_previews(file, output_dir=None, filename=None, pages=None,
+                           size: Union[int, Tuple[int]] = 256, strip=False,
+                           columns=None,
+                           background=MEDIA_THUMBNAIL_BACKGROUND,
+                           encoder: Union[str, ThumbnailEncoder] = None):
+    """
+    Generate thumbnails of several pages of a document, rendered in a
+    single poppler call. pages is a range or a set of page numbers,
+    starting from 1, and defaults to the first
+    MEDIA_DOCUMENT_PREVIEW_PAGES pages. See
+    DocumentThumbnailGenerator.generate_page_thumbnails.
+
+    Returns a list of (page, output_path) tuples, leaving out pages past
+    the end of the document. If strip is True, the pages are instead
+    packed into a single strip of tiles of size, with the given number
+    of columns (by default, a single row), and a tuple of the output
+    path and a list of the (page, x, y) positions of the tiles in it is
+    returned. If output_dir is None, nothing is written to disk and the
+    encoded bytes are returned in place of the output paths.
+
+    Returns None if the file is not a document.
+    """
+    if isinstance(file, str):
+        filename = file
+    file, _to_close = open_input(file)
+    try:
+        if not filename:
+            filename = file.name
+
+        fname, fext = os.path.splitext(os.path.split(filename)[1])
+        encoder = get_encoder(encoder, background)
+        output_format = encoder.ext
+
+        generator = _get_generator(fext)
+        if not hasattr(generator, 'generate_page_thumbnails'):
+            warnings.warn(f"Page previews are not supported for extension {fext}.")
+            return None
+
+        in_memory = output_dir is None
+        if not in_memory and not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+
+        name_size = size
+        if not isinstance(size, tuple):
+            size = (size, size)
+        pages = generator.resolve_pages(pages)
+        prefix = f'{fname}{fext.replace(".", "_")}'
+
+        with instrumentation.call('pages'):
+            if strip:
+                output_path = None
+                if not in_memory:
+                    output_path = os.path.join(
+                        output_dir, f'{prefix}_pages_{pages[0]}-{pages[-1]}'
+                                    f'_strip_{size[0]}x{size[1]}.{output_format}')
+                return generator.generate_page_strip(
+                    file, output_path, size, background, pages=pages,
+                    columns=columns, encoder=encoder)
+            targets = []
+            for page in pages:
+                output_path = None
+                if not in_memory:
+                    output_path = _get_output_path(output_dir, f'{prefix}_page{page}',
+                                                   '', name_size, output_format)
+                targets.append((page, output_path))
+            return generator.generate_page_thumbnails(file, targets, size,
+                                                      background, encoder=encoder)
+    finally:
+        if _to_close:
+            file.close()
+
+
+def generate_thumbnails_many(sources, output_dir=None, sizes=None,
+                             background=MEDIA_THUMBNAIL_BACKGROUND,
+                             workers=None, executor=None, max_in_flight=None,
+                             cache: ThumbnailCache = None, encoder=None):
+    """
+    Generate thumbnails for each of the given sources, as
+    generate_thumbnails would, on a pool of workers. By default, a process
+    pool with the given number of workers is used, in which case sources
+    should be paths. Any concurrent.futures executor can be provided
+    instead.
+
+    Sources are consumed lazily, with no more than max_in_flight of them
+    being processed or waiting on results at any time.
+
+    Yields a (source, size, output_path) tuple for each thumbnail
+    generated, in the order in which the sources complete. If a source
+    fails, a single (source, None, exception) tuple is yielded for it
+    instead. If there is no generator for the type of a source, a single
+    (source, None, None) tuple is yielded for it. If output_dir is None,
+    the encoded bytes of each thumbnail are yielded in place of its path.
+    """
+    job = partial(generate_thumbnails, output_dir=output_dir,
+                  sizes=sizes, background=background, cache=cache,
+                  encoder=encoder)
+    initializer, initargs = None, ()
+    if cache:
+        # Have each worker of the pool load the cache once, as it starts.
+        # The cache passed along with each task resolves to that instance.
+        initializer = shared_thumbnail_cache
+        initargs = (cache.cache_dir, cache.max_size)
+    for source, result in imap_unordered(job, sources,
+                                         workers=workers, executor=executor,
+                                         max_in_flight=max_in_flight,
+                                         initializer=initializer,
+                                         initargs=initargs):
+        if isinstance(result, Exception):
+            yield source, None, result
+            continue
+        if not any(result):
+            yield source, None, None
+            continue
+        for size, outpath in result:
+            yield source, size, outpath
+
+
+async def generate_thumbnail_async(file, output_dir=None, filename=None,
+                                   size: Union[int, Tuple[int]] = 256,
+                                   output_fname=None,
+                                   background=MEDIA_THUMBNAIL_BACKGROUND,
+                                   cache: ThumbnailCache = None,
+                                   encoder: Union[str, ThumbnailEncoder] = None,
+                                   output=None):
+    """
+    Asynchronous variant of generate_thumbnail. The file can be a path,
+    a regular file-like object or an async file-like object. Generation
+    runs on the shared executor of the aio module, within the concurrency
+    limit for the type of media.
+    """
+    if not filename:
+        filename = get_filename(file)
+
+    _to_close = False
+    if is_async_file(file):
+        file = await spool(file)
+        _to_close = True
+
+    try:
+        return await run_limited(get_media_type(os.path.splitext(filename)[1]),
+                                 generate_thumbnail, file, output_dir,
+                                 filename=filename, size=size,
+                                 output_fname=output_fname,
+                                 background=background, cache=cache,
+                                 encoder=encoder, output=output)
+    finally:
+        if _to_close:
+            file.close()
@@ -1,18 +1,31 @@
 
 
+import os
 import re
+import json
+import time
 import warnings
+import mimetypes
 from math import ceil
+from math import sqrt
+from decimal import Decimal
 from typing import List
 from typing import Optional
 from typing import Literal
 
 import av
+import numpy
+from av.error import FFmpegError
 from pymediainfo import MediaInfo
 from pymediainfo import Track
 
 from pydantic.dataclasses import dataclass
 
+from tendril import config
+
+from .base import rewind
+from .base import get_path
+from .base import is_streaming
 from .base import MediaFileInfo
 from .base import MediaFileInfoParser
 from .base import MediaThumbnailGenerator
@@ -22,11 +35,32 @@ from .av import VideoTrackInfo
 from .av import AudioTrackInfo
 
 
+# MediaInfo parse speeds for the full (default) and fast modes. Lower
+# parse speeds read less of the file, limiting libmediainfo to the
+# headers and indices at the lowest setting.
+MEDIA_VIDEO_INFO_PARSE_SPEED = getattr(config, 'MEDIA_VIDEO_INFO_PARSE_SPEED', 1.0)
+MEDIA_VIDEO_INFO_FAST_PARSE_SPEED = getattr(config, 'MEDIA_VIDEO_INFO_FAST_PARSE_SPEED', 0.0)
+MEDIA_VIDEO_INFO_FAST = getattr(config, 'MEDIA_VIDEO_INFO_FAST', False)
+
+# Number of keyframes to sample across the video when picking the
+# thumbnail frame, and the time budget (in seconds) for sampling them.
+# With a single candidate, the first keyframe after 10% of the duration
+# is used.
+MEDIA_VIDEO_THUMBNAIL_CANDIDATES = getattr(config, 'MEDIA_VIDEO_THUMBNAIL_CANDIDATES', 1)
+MEDIA_VIDEO_THUMBNAIL_TIME_BUDGET = getattr(config, 'MEDIA_VIDEO_THUMBNAIL_TIME_BUDGET', 2.0)
+
+# Engine used to obtain video info. One of 'pymediainfo' or 'pyav'.
+MEDIA_VIDEO_INFO_ENGINE = getattr(config, 'MEDIA_VIDEO_INFO_ENGINE', 'pymediainfo')
+
+
 @dataclass
 class VideoFileInfo(MediaFileInfo):
     general: AVFileGeneralInfo
     video: List[VideoTrackInfo]
     audio: Optional[List[AudioTrackInfo]]
+    # Fields which may have been estimated rather than measured, as
+    # 'section.field' strings. Only set when parsed in fast mode.
+    estimated_fields: Optional[List[str]] = None
 
     def __post_init__(self):
         self.general = AVFileGeneralInfo(**self.general)
@@ -46,6 +80,78 @@ class VideoFileInfo(MediaFileInfo):
 class VideoFileInfoParser(MediaFileInfoParser):
     info_class = VideoFileInfo
 
+    # Fields which libmediainfo may estimate from the headers in place of
+    # scanning the streams, or which we derive from the other fields if
+    # they are missing, when parsing in fast mode.
+    _fast_estimated_fields = [
+        'general.duration',
+        'general.overall_bit_rate',
+        'video.frame_count',
+        'video.bit_rate',
+        'video.stream_size',
+        'video.bits__pixel_frame',
+        'audio.bit_rate',
+        'audio.stream_size',
+    ]
+
+    # Fields the pyav engine derives from the other fields when the
+    # container doesn't provide them.
+    _pyav_estimated_fields = [
+        'video.frame_count',
+        'video.bit_rate',
+        'video.bits__pixel_frame',
+    ]
+
+    # FFmpeg container and codec names mapped to the format names
+    # reported by MediaInfo, for consistency between the engines.
+    _pyav_containers = {
+        'mov,mp4,m4a,3gp,3g2,mj2': 'MPEG-4',
+        'matroska,webm': 'Matroska',
+        'avi': 'AVI',
+        'asf': 'Windows Media',
+        'flv': 'Flash Video',
+        'mpeg': 'MPEG-PS',
+        'mpegts': 'MPEG-TS',
+        'ogg': 'Ogg',
+    }
+
+    _pyav_codecs = {
+        'h264': 'AVC',
+        'hevc': 'HEVC',
+        'av1': 'AV1',
+        'vp8': 'VP8',
+        'vp9': 'VP9',
+        'theora': 'Theora',
+        'mpeg4': 'MPEG-4 Visual',
+        'mpeg1video': 'MPEG Video',
+        'mpeg2video': 'MPEG Video',
+        'mjpeg': 'JPEG',
+        'wmv3': 'VC-1',
+        'vc1': 'VC-1',
+        'prores': 'ProRes',
+        'aac': 'AAC',
+        'mp2': 'MPEG Audio',
+        'mp3': 'MPEG Audio',
+        'ac3': 'AC-3',
+        'eac3': 'E-AC-3',
+        'flac': 'FLAC',
+        'opus': 'Opus',
+        'vorbis': 'Vorbis',
+        'wmav1': 'WMA',
+        'wmav2': 'WMA',
+    }
+
+    def __init__(self, fast=None, parse_speed=None, fast_parse_speed=None,
+                 engine=None):
+        self.engine = engine or MEDIA_VIDEO_INFO_ENGINE
+        self.fast = MEDIA_VIDEO_INFO_FAST if fast is None else fast
+        if parse_speed is None:
+            parse_speed = MEDIA_VIDEO_INFO_PARSE_SPEED
+        self.parse_speed = parse_speed
+        if fast_parse_speed is None:
+            fast_parse_speed = MEDIA_VIDEO_INFO_FAST_PARSE_SPEED
+        self.fast_parse_speed = fast_parse_speed
+
     def _parse_general_information(self, mi, fname=None):
         # We only really expect one general, one video, and one audio track for each
         # media file. Use cases for having more than one track, if applicable, need
@@ -127,35 +233,452 @@ class VideoFileInfoParser(MediaFileInfoParser):
         rv = [self._parse_audio_track_information(audio_track)]
         return rv
 
-    def _parse(self, file, *args, **kwargs):
+    def _estimate_av_track_information(self, track, general):
+        duration = track['duration'] or general['duration']
+        if duration:
+            duration = float(duration)
+        if not track['bit_rate'] and track['stream_size'] and duration:
+            track['bit_rate'] = int(track['stream_size'] * 8000 / duration)
+
+    def _estimate_video_track_information(self, track, general):
+        self._estimate_av_track_information(track, general)
+        duration = track['duration'] or general['duration']
+        frame_rate = track['frame_rate']
+        if not track['frame_count'] and duration and frame_rate:
+            track['frame_count'] = round(float(duration) * float(frame_rate) / 1000)
+        if not track['bits__pixel_frame'] and track['bit_rate'] and frame_rate:
+            pixels = Decimal(track['width'] * track['height']) * Decimal(frame_rate)
+            track['bits__pixel_frame'] = round(Decimal(track['bit_rate']) / pixels, 3)
+
+    def _parse_general_information_pyav(self, file, container, ext):
+        container_format = self._pyav_containers.get(container.format.name,
+                                                     container.format.name)
+        if container_format == 'Matroska' and ext == '.webm':
+            container_format = 'WebM'
+        rv = {
+            'container': container_format,
+            'file_size': self._get_size(file),
+            'duration': int(container.duration / 1000) if container.duration else None,
+            'overall_bit_rate': container.bit_rate,
+            'writing_application': container.metadata.get('encoder'),
+            'internet_media_type': mimetypes.types_map.get(ext.lower()),
+        }
+        return rv
+
+    def _parse_av_stream_information(self, stream):
+        codec_context = stream.codec_context
+        try:
+            codec_id = codec_context.codec_tag.strip('\x00') or None
+        except UnicodeDecodeError:
+            # Numeric tags, such as the 0x00ff of AAC in AVI, which PyAV
+            # tries to decode as a FourCC
+            codec_id = None
+        duration = None
+        if stream.duration and stream.time_base:
+            duration = int(stream.duration * stream.time_base * 1000)
+        rv = {
+            'format': self._pyav_codecs.get(codec_context.name, codec_context.name),
+            'codec_id': codec_id,
+            'duration': duration,
+            'bit_rate': stream.bit_rate or codec_context.bit_rate or None,
+            'stream_size': None,
+            'encoded_date': stream.metadata.get('creation_time'),
+            'tagged_date': None,
+        }
+        return rv
+
+    def _parse_video_stream_information(self, stream):
+        rv = self._parse_av_stream_information(stream)
+        codec_context = stream.codec_context
+        pix_fmt = codec_context.pix_fmt or ''
+        subsampling = re.match(r'^yuvj?(4\d\d)', pix_fmt)
+        frame_rate = stream.average_rate or stream.guessed_rate
+        if pix_fmt.startswith('yuv'):
+            color_space = 'YUV'
+        elif pix_fmt.startswith(('rgb', 'bgr', 'gbr')):
+            color_space = 'RGB'
+        else:
+            color_space = None
+        rv['format_profile'] = codec_context.profile
+        rv['format_settings'] = None
+        rv['width'] = codec_context.width
+        rv['height'] = codec_context.height
+        rv['bit_depth'] = codec_context.format.components[0].bits if codec_context.format else None
+        rv['frame_count'] = stream.frames or None
+        rv['frame_rate'] = round(Decimal(float(frame_rate)), 3) if frame_rate else None
+        rv['frame_rate_mode'] = None
+        rv['color_space'] = color_space
+        rv['chroma_subsampling'] = ':'.join(subsampling.group(1)) if subsampling else None
+        rv['bits__pixel_frame'] = None
+        rv['writing_library'] = stream.metadata.get('encoder')
+        rv['rotation'] = stream.metadata.get('rotate')
+        return rv
+
+    def _parse_audio_stream_information(self, stream):
+        rv = self._parse_av_stream_information(stream)
+        codec_context = stream.codec_context
+        layout = codec_context.layout
+        rv['format_additionalfeatures'] = None
+        rv['muxing_mode'] = None
+        rv['channels'] = getattr(codec_context, 'channels', None) or len(layout.channels)
+        rv['channel_layout'] = layout.name
+        rv['sampling_rate'] = codec_context.sample_rate
+        rv['compression_mode'] = None
+        return rv
+
+    def _parse_pyav_container(self, file, container, ext, fname=None):
+        rv = {'general': self._parse_general_information_pyav(file, container, ext)}
+        if len(container.streams.video) > 1:
+            warnings.warn(f"Got multiple Video Tracks for Video File f{fname}")
+        rv['video'] = [self._parse_video_stream_information(container.streams.video[0])]
+        if not len(container.streams.audio):
+            warnings.warn(f"Got no usable Audio Tracks for Audio File f{fname}")
+            rv['audio'] = []
+        else:
+            if len(container.streams.audio) > 1:
+                warnings.warn(f"Got multiple Audio Tracks for Video File f{fname}")
+            rv['audio'] = [self._parse_audio_stream_information(container.streams.audio[0])]
+        return rv
+
+    def _parse_pyav(self, file, ext, fname=None, container=None):
+        # Only the container and stream headers are read. No packets are
+        # demuxed or decoded. An already open container can be provided,
+        # which is left open for decoding the thumbnail from.
+        if container is not None:
+            rv = self._parse_pyav_container(file, container, ext, fname=fname)
+        else:
+            with av.open(get_path(file) or file, 'r') as container:
+                rv = self._parse_pyav_container(file, container, ext, fname=fname)
+
+        general = rv['general']
+        video = rv['video'][0]
+        for track in [video] + rv['audio']:
+            # Some containers, such as WebM, only carry the duration of the
+            # container as a whole
+            if track['duration'] is None:
+                track['duration'] = general['duration']
+        if not video['bit_rate'] and general['overall_bit_rate']:
+            audio_bit_rate = sum(x['bit_rate'] or 0 for x in rv['audio'])
+            video['bit_rate'] = general['overall_bit_rate'] - audio_bit_rate
+        for track in rv['audio']:
+            track['bit_rate'] = track['bit_rate'] or 0
+        self._estimate_video_track_information(video, general)
+        rv['estimated_fields'] = list(self._pyav_estimated_fields)
+        return rv
+
+    def _parse_pymediainfo(self, file, fast, parse_speed, fname=None):
+        if parse_speed is None:
+            parse_speed = self.fast_parse_speed if fast else self.parse_speed
+        rv = {}
+        # libmediainfo is given the file-like object and not the path.
+        # Given a path, the first parse of a video in a process can report
+        # different stream sizes and frame counts (for the audio of
+        # test.mov, 1024 frames instead of 1433), which would then be
+        # cached. Through a file-like object, it reads the same data and
+        # the results are stable.
+        mi = MediaInfo.parse(file, parse_speed=parse_speed)
+        rv['general'] = self._parse_general_information(mi, fname=fname)
+        rv['video'] = self._parse_video_information(mi, fname=fname)
+        rv['audio'] = self._parse_audio_information(mi, fname=fname)
+        if fast:
+            for track in rv['video']:
+                self._estimate_video_track_information(track, rv['general'])
+            for track in rv['audio']:
+                self._estimate_av_track_information(track, rv['general'])
+            rv['estimated_fields'] = list(self._fast_estimated_fields)
+        return rv
+
+    def _parse(self, file, *args, engine=None, fast=None, parse_speed=None,
+               container=None, **kwargs):
+        # container is a PyAV container already opened on the file. It is
+        # only used by the pyav engine.
         ofname = kwargs.get('filename') or kwargs.get('original_filename')
         rv = super(VideoFileInfoParser, self)._parse(file, *args, **kwargs)
-        mi = MediaInfo.parse(file, parse_speed=1.0)
-        rv['general'] = self._parse_general_information(mi, fname=ofname)
-        rv['video'] = self._parse_video_information(mi, fname=ofname)
-        rv['audio'] = self._parse_audio_information(mi, fname=ofname)
+        if fast is None:
+            fast = self.fast
+        if (engine or self.engine) == 'pyav':
+            rv.update(self._parse_pyav(file, rv['ext'], fname=ofname,
+                                       container=container))
+        else:
+            rv.update(self._parse_pymediainfo(file, fast, parse_speed, fname=ofname))
         return rv
 
 
 class VideoThumbnailGenerator(MediaThumbnailGenerator):
-    def generate_thumbnail(self, file, output_path, size,
-                           background, output_format='png'):
-        file.seek(0)
-        container = av.open(file, 'r')
-        duration = container.duration * 1e-6
-        thumb_frame_time = duration * 0.1
+    # Position of the thumbnail frame as a fraction of the duration
+    thumb_position = 0.1
+
+    # Range of the duration across which candidate frames are sampled,
+    # and the width of the frames candidates are scored at.
+    candidate_span = (0.05, 0.95)
+    score_width = 64
+
+    def __init__(self, candidates=None, time_budget=None):
+        self.candidates = candidates or MEDIA_VIDEO_THUMBNAIL_CANDIDATES
+        self.time_budget = time_budget or MEDIA_VIDEO_THUMBNAIL_TIME_BUDGET
+
+    def _is_seekable(self, file):
+        if get_path(file):
+            return True
+        if is_streaming(file):
+            # Seeking would read the remainder of the stream
+            return False
+        if hasattr(file, 'seekable'):
+            return file.seekable()
+        return hasattr(file, 'seek')
+
+    def _open_container(self, file, forward_only=True):
+        # Let FFmpeg read the file directly if it's on disk
+        path = get_path(file)
+        if path:
+            container = av.open(path, 'r')
+        elif is_streaming(file) and forward_only:
+            # Give FFmpeg a stream it can't seek in, or it seeks to the end
+            # to find the size of the file and so reads all of it. Formats
+            # which need random access to even be opened, such as an MP4
+            # with its index at the end, are opened on the spool instead.
+            rewind(file)
+            try:
+                container = av.open(file.forward(), 'r')
+            except (FFmpegError, OSError):
+                rewind(file)
+                container = av.open(file, 'r')
+        else:
+            rewind(file)
+            container = av.open(file, 'r')
+        return container, self._keyframe_stream(container)
+
+    def _keyframe_stream(self, container):
         stream = container.streams.video[0]
         stream.codec_context.skip_frame = "NONKEY"
+        return stream
 
-        image = None
+    def open_container(self, file):
+        """
+        Open a PyAV container on the file, for sharing between the info
+        parser (with the pyav engine) and load_keyframe. See process_media.
+        Streams are opened as the info parser would open them, with random
+        access to the spool, as the info needs the whole of the container.
+        """
+        return self._open_container(file, forward_only=False)[0]
+
+    def _scan_keyframe(self, container, stream, thumb_frame_time):
         for frame in container.decode(stream):
-            if frame.time > thumb_frame_time:
-                image = frame.to_image()
+            if frame.time is not None and frame.time > thumb_frame_time:
+                return frame.to_image()
+        return None
+
+    def _seek_frame(self, container, stream, thumb_frame_time):
+        # Seek to the nearest keyframe before the thumb frame time and decode
+        # forward from there. Only the keyframes in the immediate vicinity
+        # of the target are decoded, instead of every keyframe from the
+        # start of the stream.
+        offset = int(thumb_frame_time / stream.time_base)
+        container.seek(offset, stream=stream, backward=True, any_frame=False)
+        last = None
+        for frame in container.decode(stream):
+            last = frame
+            if frame.time is not None and frame.time > thumb_frame_time:
+                break
+        return last
+
+    def _seek_keyframe(self, container, stream, thumb_frame_time):
+        frame = self._seek_frame(container, stream, thumb_frame_time)
+        if frame is None:
+            return None
+        return frame.to_image()
+
+    def _score_frame(self, frame):
+        # Entropy of the luminance histogram of a downscaled copy of the
+        # frame. Black fades and flat title cards score low.
+        height = max(1, int(frame.height * self.score_width / frame.width))
+        pixels = frame.to_ndarray(width=self.score_width, height=height, format='gray')
+        histogram = numpy.bincount(pixels.ravel(), minlength=256)
+        p = histogram[histogram > 0] / pixels.size
+        return float(-(p * numpy.log2(p)).sum())
+
+    def _candidate_times(self, duration):
+        start, end = self.candidate_span
+        rv = [duration * self.thumb_position]
+        for idx in range(self.candidates - 1):
+            rv.append(duration * (start + (end - start) * (idx + 0.5) / (self.candidates - 1)))
+        return rv
+
+    def _select_keyframe(self, container, stream, duration):
+        # Sample keyframes across the stream and keep the one with the
+        # best score. The default thumbnail position is sampled first, and
+        # sampling stops once the time budget is exhausted.
+        deadline = time.monotonic() + self.time_budget
+        best, best_score = None, None
+        for thumb_frame_time in self._candidate_times(duration):
+            frame = self._seek_frame(container, stream, thumb_frame_time)
+            if frame is not None:
+                score = self._score_frame(frame)
+                if best_score is None or score > best_score:
+                    best, best_score = frame, score
+            if time.monotonic() > deadline:
                 break
+        if best is None:
+            return None
+        return best.to_image()
+
+    def _load_image(self, file, size):
+        return self.load_keyframe(file)
+
+    def load_keyframe(self, file, container=None):
+        """
+        Decode the thumbnail frame of the video as a PIL Image. If a
+        container already opened on the file by open_container is
+        provided, the frame is decoded from it instead of opening the file
+        again, and it is left open for the caller to close.
+        """
+        owned = container is None
+        if owned:
+            container, stream = self._open_container(file)
+        else:
+            stream = self._keyframe_stream(container)
+        if is_streaming(file) or not container.duration:
+            # Use the first keyframe, which for a fragmented MP4 or a
+            # WebM is read from the head of the stream. The duration may
+            # also not be known without reading all of it.
+            duration = 0
+            thumb_frame_time = -1
+        else:
+            duration = container.duration * 1e-6
+            thumb_frame_time = duration * self.thumb_position
+
+        image = None
+        if self._is_seekable(file) and stream.time_base:
+            try:
+                if self.candidates > 1:
+                    image = self._select_keyframe(container, stream, duration)
+                else:
+                    image = self._seek_keyframe(container, stream, thumb_frame_time)
+            except (FFmpegError, OSError):
+                image = None
+            if not image:
+                # The demuxer couldn't seek in this container after all.
+                # Start over and fall back to the linear scan.
+                if owned:
+                    container.close()
+                container, stream = self._open_container(file)
+                owned = True
+
+        if not image and is_streaming(file):
+            try:
+                image = self._scan_keyframe(container, stream, thumb_frame_time)
+            except (FFmpegError, OSError):
+                image = None
+            if not image:
+                # The demuxer needed random access after all. Start over on
+                # the spool, which reads the rest of the stream as needed.
+                if owned:
+                    container.close()
+                container, stream = self._open_container(file, forward_only=False)
+                owned = True
+
+        if not image:
+            image = self._scan_keyframe(container, stream, thumb_frame_time)
+
+        if owned:
+            container.close()
 
         if not image:
             raise Exception("Something strange happened. No viable thumb frame found!")
 
-        image.thumbnail(size)
-        file.seek(0)
-        return self.pack_and_write(size, output_path, image, background)
+        if not get_path(file):
+            rewind(file)
+        return image
+
+    def _format_vtt_time(self, t):
+        hours, rem = divmod(t, 3600)
+        minutes, seconds = divmod(rem, 60)
+        return f'{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}'
+
+    def _write_sprite_index(self, index_path, index_format, tiles, url, tile_size):
+        if index_format == 'vtt':
+            lines = ['WEBVTT', '']
+            for tile in tiles:
+                lines.append(f"{self._format_vtt_time(tile['start'])} --> "
+                             f"{self._format_vtt_time(tile['end'])}")
+                lines.append(f"{url}#xywh={tile['x']},{tile['y']},"
+                             f"{tile_size[0]},{tile_size[1]}")
+                lines.append('')
+            content = '\n'.join(lines)
+        elif index_format == 'json':
+            content = json.dumps({'image': url,
+                                  'tile_width': tile_size[0],
+                                  'tile_height': tile_size[1],
+                                  'tiles': tiles}, indent=2)
+        else:
+            raise ValueError(f"Unsupported sprite index format {index_format}")
+        with open(index_path, 'w') as f:
+            f.write(content)
+        return index_path
+
+    def generate_sprite_sheet(self, file, output_path, tile_size, background,
+                              interval=10, columns=None, max_tiles=100,
+                              index_path=None, index_format='vtt',
+                              url=None, keyframes_only=False, encoder=None):
+        """
+        Generate a sprite sheet of frames taken every interval seconds,
+        each fitted into a tile of tile_size and packed into a grid with
+        the given number of columns (by default, roughly square). The
+        stream is decoded in a single forward pass.
+
+        If index_path is provided, an index of the time range and the
+        coordinates of each tile is written to it, either as WebVTT
+        thumbnail cues or as JSON. Tiles are referred to by url, which
+        defaults to the file name of the sprite sheet.
+
+        With keyframes_only, only keyframes are decoded, which is much
+        faster but places tiles at the first keyframe after each interval.
+
+        Returns a tuple of output_path and index_path.
+        """
+        background = background or (0, 0, 0)
+        container, stream = self._open_container(file)
+        if not keyframes_only:
+            stream.codec_context.skip_frame = "DEFAULT"
+        stream.thread_type = "AUTO"
+
+        images, times = [], []
+        next_time = 0
+        for frame in container.decode(stream):
+            if frame.time is None or frame.time < next_time:
+                continue
+            image = frame.to_image()
+            image.thumbnail(tile_size)
+            images.append(self.pack(tile_size, image, background))
+            times.append(frame.time)
+            while next_time <= frame.time:
+                next_time += interval
+            if len(images) >= max_tiles:
+                break
+
+        duration = container.duration * 1e-6 if container.duration else next_time
+        container.close()
+        if not get_path(file):
+            rewind(file)
+
+        if not images:
+            raise Exception("Something strange happened. No viable sprite frames found!")
+
+        if not columns:
+            columns = ceil(sqrt(len(images)))
+        rows = ceil(len(images) / columns)
+        sheet = self._new_canvas((columns * tile_size[0], rows * tile_size[1]), background)
+
+        tiles = []
+        for idx, image in enumerate(images):
+            x = (idx % columns) * tile_size[0]
+            y = (idx // columns) * tile_size[1]
+            sheet.paste(image, (x, y))
+            end = times[idx + 1] if idx + 1 < len(times) else max(duration, times[idx])
+            tiles.append({'start': times[idx], 'end': end, 'x': x, 'y': y})
+
+        self.write(output_path, sheet, encoder=encoder)
+        if index_path:
+            url = url or os.path.split(output_path)[1]
+            self._write_sprite_index(index_path, index_format, tiles, url, tile_size)
+        return output_path, index_path
@@ -0,0 +1,23 @@
+
+
+import time
+from tendril.config import MEDIA_VIDEO_EXTENSIONS
+from tendril.utils.parsers.media.info import get_media_info
+
+
+ENGINES = ['pymediainfo', 'pyav']
+REPEATS = 20
+
+
+for ext in MEDIA_VIDEO_EXTENSIONS:
+    fp = 'media/test' + ext
+    print("### : ", ext)
+    for engine in ENGINES:
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            info = get_media_info(fp, original_filename=fp, engine=engine)
+        elapsed = (time.perf_counter() - start) / REPEATS
+        print(f"{engine:>12} : {elapsed * 1000:8.2f} ms/file, "
+              f"Width : {info.width()}, Height: {info.height()}, "
+              f"Duration : {info.duration()}")
+    print('----------------------------------')
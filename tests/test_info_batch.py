@@ -0,0 +1,14 @@
+
+
+from tendril.config import MEDIA_EXTENSIONS
+from tendril.utils.parsers.media.info import get_media_info_many
+
+
+paths = ['media/test' + ext for ext in MEDIA_EXTENSIONS]
+for fp, info in get_media_info_many(paths, workers=4):
+    print("### : ", fp)
+    if isinstance(info, Exception):
+        print(f"Failed : {info!r}")
+    else:
+        print(f"Width : {info.width()}, Height: {info.height()}")
+    print('----------------------------------')
@@ -11,3 +11,12 @@ for ext in MEDIA_DOCUMENT_EXTENSIONS:
     print(f"Width : {info.width()}, Height: {info.height()}")
     print(info.json())
     print('----------------------------------')
+
+
+for ext in MEDIA_DOCUMENT_EXTENSIONS:
+    fp = 'media/test' + ext
+    print("### : ", ext, "(fast)")
+    info = get_media_info(fp, original_filename=fp, fast=True)
+    print(f"Pages : {info.document.pages}")
+    print(info.json())
+    print('----------------------------------')
@@ -9,7 +9,10 @@ for ext in MEDIA_VIDEO_EXTENSIONS:
     fp = 'media/test' + ext
     print("### : ", ext)
     # print(MediaInfo.parse(fp).to_data())
-    info = get_media_info(fp)
+    info = get_media_info(fp, original_filename=fp)
     print(f"Width : {info.width()}, Height: {info.height()}")
     print(info.json())
+    # libmediainfo should report the same info on every parse, including
+    # the first in the process, which is the one a cache would keep.
+    assert get_media_info(fp, original_filename=fp) == info
     print('----------------------------------')
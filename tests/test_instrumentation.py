@@ -0,0 +1,33 @@
+
+
+from pprint import pprint
+from itertools import chain
+from tendril.config import MEDIA_VIDEO_EXTENSIONS
+from tendril.config import MEDIA_IMAGE_EXTENSIONS
+from tendril.config import MEDIA_DOCUMENT_EXTENSIONS
+from tendril.utils.parsers.media.info import get_media_info
+from tendril.utils.parsers.media.thumbnails import generate_thumbnail
+from tendril.utils.parsers.media.thumbnails import generate_thumbnails
+from tendril.utils.parsers.media.instrumentation import add_hook
+from tendril.utils.parsers.media.instrumentation import HistogramAggregator
+
+
+aggregator = HistogramAggregator()
+add_hook(aggregator)
+add_hook(lambda record: print(f"{record.operation} : {record.stages} {record.attributes}"))
+
+for ext in chain(MEDIA_VIDEO_EXTENSIONS, MEDIA_IMAGE_EXTENSIONS, MEDIA_DOCUMENT_EXTENSIONS):
+    fp = 'media/test' + ext
+    print("### : ", ext)
+    for fn, args, kwargs in [(get_media_info, (fp,), {'original_filename': fp}),
+                             (generate_thumbnail, (fp,), {'size': 256}),
+                             (generate_thumbnails, (fp, 'thumbs'), {})]:
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            # Failed calls are recorded too, and counted in the errors
+            # of the summary totals.
+            print(f"Failed : {e!r}")
+    print('----------------------------------')
+
+pprint(aggregator.summary())
@@ -0,0 +1,22 @@
+
+
+from itertools import chain
+from tendril.config import MEDIA_VIDEO_EXTENSIONS
+from tendril.config import MEDIA_IMAGE_EXTENSIONS
+from tendril.config import MEDIA_DOCUMENT_EXTENSIONS
+from tendril.utils.parsers.media.process import process_media
+
+
+for ext in chain(MEDIA_VIDEO_EXTENSIONS, MEDIA_IMAGE_EXTENSIONS, MEDIA_DOCUMENT_EXTENSIONS):
+    fp = 'media/test' + ext
+    print("### : ", ext)
+    info, thumbnails = process_media(fp, output_dir='thumbs', original_filename=fp)
+    print(f"Width : {info.width()}, Height: {info.height()}")
+    print(f"Thumbnails Generated : {thumbnails}")
+    if ext in MEDIA_VIDEO_EXTENSIONS:
+        # The info and the thumbnail frame are read from one container
+        info, thumbnails = process_media(fp, output_dir='thumbs', original_filename=fp,
+                                         engine='pyav')
+        print(f"PyAV Width : {info.width()}, Height: {info.height()}")
+        print(f"PyAV Thumbnails Generated : {thumbnails}")
+    print('----------------------------------')
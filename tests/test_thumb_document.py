@@ -3,6 +3,7 @@
 from tendril.config import MEDIA_DOCUMENT_EXTENSIONS
 from tendril.utils.parsers.media.thumbnails import generate_thumbnail
 from tendril.utils.parsers.media.thumbnails import generate_thumbnails
+from tendril.utils.parsers.media.thumbnails import generate_page_previews
 
 
 for ext in MEDIA_DOCUMENT_EXTENSIONS:
@@ -19,3 +20,11 @@ fp = 'media/test.pdf'
 with open(fp, 'rb') as f:
     output_files = generate_thumbnails(f, output_dir='thumbs')
 print(f"Thumbnails Generated : {output_files}")
+
+
+print("### : Page Previews")
+fp = 'media/test.pdf'
+outputs = generate_page_previews(fp, output_dir='thumbs', pages=range(1, 4))
+print(f"Page Thumbnails Generated : {outputs}")
+outputs = generate_page_previews(fp, output_dir='thumbs', pages={1, 3}, size=(160, 226), strip=True)
+print(f"Page Strip Generated : {outputs}")
@@ -0,0 +1,14 @@
+
+
+from tendril.config import MEDIA_VIDEO_EXTENSIONS
+from tendril.utils.parsers.media.thumbnails import generate_sprite_sheet
+
+
+for ext in MEDIA_VIDEO_EXTENSIONS:
+    fp = 'media/test' + ext
+    print("### : ", ext)
+    for index_format in ('vtt', 'json'):
+        output_files = generate_sprite_sheet(fp, output_dir='thumbs', interval=1,
+                                             index_format=index_format)
+        print(f"Sprite Sheet Generated : {output_files}")
+    print('----------------------------------')
@@ -0,0 +1,66 @@
+
+
+import io
+import os
+from itertools import chain
+from tendril.config import MEDIA_VIDEO_EXTENSIONS
+from tendril.config import MEDIA_IMAGE_EXTENSIONS
+from tendril.config import MEDIA_DOCUMENT_EXTENSIONS
+from tendril.utils.parsers.media.info import get_media_info
+from tendril.utils.parsers.media.thumbnails import generate_thumbnail
+
+
+# Formats whose first keyframe can be reached without reading the whole
+# stream. An MP4 or MOV with its index at the end needs all of it.
+STREAMABLE_EXTENSIONS = ['.webm', '.mkv']
+
+# Formats whose info the PIL engine reads from the image header alone.
+HEADER_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif']
+
+
+class Pipe(io.RawIOBase):
+    # Stands in for an upload or a pipe, which can't seek.
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self.name = os.path.split(path)[1]
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readinto(self, b):
+        n = self._file.readinto(b)
+        self.bytes_read += n
+        return n
+
+    def close(self):
+        self._file.close()
+        super(Pipe, self).close()
+
+
+for ext in chain(MEDIA_VIDEO_EXTENSIONS, MEDIA_IMAGE_EXTENSIONS, MEDIA_DOCUMENT_EXTENSIONS):
+    fp = 'media/test' + ext
+    print("### : ", ext)
+    with Pipe(fp) as pipe:
+        print(get_media_info(pipe, original_filename=fp))
+        print(f"Bytes Read : {pipe.bytes_read}")
+    if ext in HEADER_EXTENSIONS:
+        with Pipe(fp) as pipe:
+            info = get_media_info(pipe, original_filename=fp, engine='pil',
+                                  length=os.path.getsize(fp))
+            print(f"Header Bytes Read : {pipe.bytes_read} of {os.path.getsize(fp)}")
+            # Only the image header should have been read, with the file
+            # size taken from the length provided
+            assert pipe.bytes_read < os.path.getsize(fp)
+            assert info.general.file_size == os.path.getsize(fp)
+    with Pipe(fp) as pipe:
+        print(generate_thumbnail(pipe, 'thumbs', size=256))
+        print(f"Bytes Read : {pipe.bytes_read} of {os.path.getsize(fp)}")
+        if ext in STREAMABLE_EXTENSIONS:
+            # Only the head of the stream, up to the first keyframe,
+            # should have been read
+            assert pipe.bytes_read < os.path.getsize(fp)
+    print('----------------------------------')